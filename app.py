@@ -4,13 +4,23 @@ this is where you'll find all of the get/post request handlers
 the socket event handlers are inside of socket_routes.py
 '''
 
-from flask import Flask, render_template, request, abort, url_for, session, redirect
+from flask import Flask, render_template, request, abort, url_for, session, redirect, g
 from flask_socketio import SocketIO
+import hashing
+# the hashing workers are forked before db.py, the bus and the background writers start their threads
+hashing.pool.start()
 import db
+import bulk
+import config
+import metrics
+from presence import registry as presence
 import secrets
 import ssl
 from flask import jsonify
-import json
+from datetime import datetime
+from time import perf_counter
+import click
+import sys
 
 
 import logging
@@ -23,7 +33,10 @@ app = Flask(__name__)
 
 # secret key used to sign the session cookie
 app.config['SECRET_KEY'] = secrets.token_hex()
-socketio = SocketIO(app)
+# with a message queue configured, emits to a room reach clients connected to any app node
+# liveness is checked by engine.io's ping/pong on each socket, pages don't poll the server
+socketio = SocketIO(app, message_queue=config.SOCKETIO_MESSAGE_QUEUE,
+                    ping_interval=config.SOCKETIO_PING_INTERVAL, ping_timeout=config.SOCKETIO_PING_TIMEOUT)
 
 
 # SSL certificate and private key paths
@@ -36,6 +49,61 @@ ssl_context.load_cert_chain(certfile, keyfile)
 
 # don't remove this!!
 import socket_routes
+from notifications import notify
+
+# records the latency of every socket event, and of every request below
+if config.METRICS_ENABLED:
+    metrics.instrument_socketio(socketio)
+    metrics.register(metrics.Collector(
+        "message_writer", "Background writer of chat messages", socket_routes.message_writer.stats,
+        counters=("submitted", "written", "dropped", "failed", "batches")))
+    metrics.register(metrics.Collector(
+        "hash_pool", "Password hashing pool", hashing.pool.stats, counters=("completed", "rejected")))
+    metrics.register(metrics.Collector(
+        "room_broadcaster", "Batched room broadcasts", socket_routes.broadcaster.stats,
+        counters=("published", "frames")))
+    metrics.register(metrics.Collector(
+        "cache", "Lookup caches of db.py", db.cache_stats, counters=("hits", "misses"), labels=("cache",)))
+
+# registered before the unit of work hooks, so the commit is part of the request's time
+@app.before_request
+def start_request_timer():
+    g.request_started = perf_counter()
+
+@app.after_request
+def record_request(response):
+    started = g.pop('request_started', None)
+    if config.METRICS_ENABLED and started is not None:
+        # the route pattern, not the path, so requests for different articles share one series
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metrics.http_request_duration.observe(perf_counter() - started, request.method, route)
+        metrics.http_requests.inc(request.method, route, response.status_code)
+    return response
+
+# every request shares one database session and commits it once at the end,
+# except logging in and signing up: they wait on the hashing pool for up to HASH_TIMEOUT seconds,
+# so their db calls use short sessions instead of holding a pooled connection while they wait
+NO_UNIT_OF_WORK = {"login_user", "signup_user"}
+
+@app.before_request
+def begin_unit_of_work():
+    if request.endpoint not in NO_UNIT_OF_WORK:
+        g.unit_of_work = db.begin_unit_of_work()
+
+@app.after_request
+def commit_unit_of_work(response):
+    # flask also runs this for a view that raised, with the 500 response it made for the error,
+    # so a server error rolls the request's changes back instead of committing them
+    error = RuntimeError("request failed") if response.status_code >= 500 else None
+    if not db.end_unit_of_work(g.pop('unit_of_work', None), error):
+        # the request's changes were rolled back, so it must not look like it succeeded
+        return app.response_class("Error: Your changes could not be saved, please try again!", status=500)
+    return response
+
+# the unit of work is only left over here if the request failed before after_request
+@app.teardown_request
+def rollback_unit_of_work(error):
+    db.end_unit_of_work(g.pop('unit_of_work', None), error or RuntimeError("request failed"))
 
 # index page
 @app.route("/")
@@ -49,8 +117,6 @@ def login():
 
 @app.route("/logout")
 def logout():    
-    username = session.get('username')
-    db.change_online_status(username, False)
     session.pop('username', default=None)
     return redirect(url_for('login'))
 
@@ -66,11 +132,21 @@ def login_user():
     if user is None:
         return "Error: User does not exist!"
 
-    if not user.check_password(password):
-        return "Error: Password does not match!"
+    try:
+        if not user.check_password(password):
+            return "Error: Password does not match!"
+    except hashing.HashingBusy:
+        return "Error: Server is busy, please try again!"
+
+    # upgrade hashes made with older parameters while the plaintext is at hand,
+    # a busy pool only postpones the upgrade to a later login
+    if user.needs_rehash():
+        try:
+            db.rehash_password(username, password)
+        except hashing.HashingBusy:
+            pass
 
     session['username'] = username  # Store username in session
-    db.change_online_status(username, True) # Change user's online status to true
 
     return url_for('friends', username=request.json.get("username"))
 
@@ -88,7 +164,10 @@ def signup_user():
     password = request.json.get("password")
 
     if db.get_user(username) is None:
-        db.insert_user(username, password)
+        try:
+            db.insert_user(username, password)
+        except hashing.HashingBusy:
+            return "Error: Server is busy, please try again!"
         return url_for('login')
     return "Error: User already exists!"
 
@@ -110,8 +189,9 @@ def chat():
         # Retrieve username from session
         username = session['username']
 
-        # Get the friend's username from the query parameter
-        friends = db.get_friends(username)
+        # the user's friends and chat permission
+        profile = db.get_profile(username)
+        friends = profile["friends"]
 
         # get all group chat rooms available 
         chats = db.get_chat_room_names()
@@ -119,7 +199,7 @@ def chat():
         # get all group chat rooms available 
         user_chats = db.get_user_chatrooms(username)
         
-        can_chat = db.get_user(username).chat        
+        can_chat = profile["chat"]
 
         # Here you can perform any additional logic you need, such as checking if the friend exists, etc.
         return render_template("chat.jinja", username=username, friends=friends, 
@@ -135,14 +215,14 @@ def friends():
         # Retrieve username from session
         username = session['username']
         
-        # Get friends for the authenticated user
-        friends = db.get_friends(username)
-        requests = db.get_requests(username)
-        account_type = db.get_user_role(username)
+        # Get friends, pending requests and role for the authenticated user
+        profile = db.get_profile(username)
+        friends = profile["friends"]
+        requests = profile["requests"]
+        account_type = profile["role"]
         
-        online = []
-        for f in friends:
-            online.append(db.get_online_status(f))
+        # presence is tracked in memory from the socket connections
+        online = [presence.is_online(f) for f in friends]
 
         return render_template("profile.jinja", username=username, 
                                friends=friends, 
@@ -162,6 +242,7 @@ def add_friend():
     else:
         if db.send_request(username, recipient) == None:
             return "Error: recipient invalid"
+        notify(recipient, "friend_request", {"sender": username})
     return url_for('friends')
 
 @app.route("/friends/remove", methods=["POST"])
@@ -174,10 +255,10 @@ def remove_friend():
     if db.get_user(friend) is None or friend == username:
         return "Error: recipient invalid"
     else:
-        if db.remove_friend(username, friend) == None:
-            return "Error: recipient invalid"
-        elif db.remove_friend(friend, username) == None:
+        if not db.remove_friendship(username, friend):
             return "Error: recipient invalid"
+        notify(username, "friend_removed", {"friend": friend})
+        notify(friend, "friend_removed", {"friend": username})
     return url_for('friends')
 
 @app.route("/friends/accept", methods=["POST"])
@@ -187,9 +268,12 @@ def accept_friend_request():
     sender = request.json.get("sender")
     username = session.get('username')  # Retrieve username from session
     
-    db.delete_requests(sender, username)
-    db.insert_friend(username, sender)
-    db.insert_friend(sender, username)
+    if not db.accept_friend_request(username, sender):
+        return "Error: friend request not found"
+    # both users' open pages show the new friendship straight away
+    notify(username, "friend_request_removed", {"sender": sender})
+    notify(username, "friend_added", {"friend": sender, "online": presence.is_online(sender)})
+    notify(sender, "friend_added", {"friend": username, "online": presence.is_online(username)})
     return url_for('friends')
 
 @app.route("/friends/decline", methods=["POST"])
@@ -200,20 +284,140 @@ def decline_friend_request():
     username = session.get('username')  # Retrieve username from session
 
     db.delete_requests(sender, username)
+    notify(username, "friend_request_removed", {"sender": sender})
     return url_for('friends')
 
+FRIEND_SUGGESTIONS = 10
+MAX_FRIEND_SUGGESTIONS = 50
+
+# friends of the user's friends, with how many friends they have in common
+@app.route("/friends/suggestions")
+def friend_suggestions():
+    if 'username' not in session:
+        abort(404)
+    limit = request.args.get("limit", FRIEND_SUGGESTIONS, type=int)
+    # a negative limit means no limit at all to sqlite
+    limit = max(1, min(limit, MAX_FRIEND_SUGGESTIONS))
+    suggestions = db.suggest_friends(session['username'], limit=limit)
+    if suggestions is None:
+        return jsonify({"error": "Suggestions could not be loaded"}), 500
+    return jsonify(suggestions)
+
+# the friends the user has in common with another user
+@app.route("/friends/mutual")
+def mutual_friends():
+    if 'username' not in session:
+        abort(404)
+    other = request.args.get("username")
+    if other is None:
+        return jsonify({"error": "Username is required"}), 400
+    mutual = db.get_mutual_friends(session['username'], other)
+    if mutual is None:
+        return jsonify({"error": "Mutual friends could not be loaded"}), 500
+    return jsonify(mutual)
+
+ARTICLES_PER_PAGE = 20
+
 @app.route("/forum")
 def forum():
     if 'username' not in session:
         # Redirect to login if user is not authenticated
         return redirect(url_for('login'))
     username = session.get('username')  # Retrieve username from session
-    can_post = db.get_user(username).post
-    articles = db.get_all_articles()
-    account_type = db.get_user_role(username)
+    user = db.get_user(username)
+    can_post = user.post
+    account_type = user.role
+
+    # articles are listed a page at a time, filtered in the database
+    category = request.args.get("category") or None
+    author = request.args.get("author") or None
+    before = request.args.get("before") or None
+    # newest first unless sorted by activity, see db.ARTICLE_ORDERINGS
+    sort = request.args.get("sort")
+    if sort not in db.ARTICLE_ORDERINGS:
+        sort = "recent"
+    page = db.list_articles(category=category, author=author, before=before, limit=ARTICLES_PER_PAGE,
+                            order=sort)
+    if page is None:
+        page = {"articles": [], "cursor": None}
 
     return render_template("forum.jinja", username=username, can_post=can_post,
-                           articles=articles, account_type=account_type)
+                           articles=page["articles"], next_cursor=page["cursor"], sort=sort,
+                           category=category, author=author, account_type=account_type)
+
+# returns a single article with its content, loaded when the article is opened
+@app.route("/forum/article")
+def get_article_content():
+    if 'username' not in session:
+        abort(404)
+    article_id = request.args.get("article_id")
+    if article_id is None:
+        return jsonify({"error": "Article ID is required"}), 400
+
+    article = db.get_article(article_id)
+    if article is None:
+        return jsonify({"error": "Article not found"}), 404
+
+    return jsonify({
+        'article_id': article.article_id,
+        'title': article.title,
+        'author_id': article.author_id,
+        'date_posted': article.date_posted.strftime('%Y-%m-%d %H:%M:%S'),
+        'category': article.category,
+        'content': article.content,
+    })
+
+SEARCH_RESULTS_PER_PAGE = 20
+
+# ranked full text search over articles and comments
+@app.route("/forum/search")
+def search_forum():
+    if 'username' not in session:
+        abort(404)
+    query = request.args.get("q", "")
+    try:
+        offset = max(0, int(request.args.get("offset", 0)))
+    except ValueError:
+        return jsonify({"error": "Invalid offset"}), 400
+
+    page = db.search_forum(query, limit=SEARCH_RESULTS_PER_PAGE, offset=offset)
+    if page is None:
+        return jsonify({"error": "Search failed"}), 500
+
+    for result in page["results"]:
+        if isinstance(result["date_posted"], datetime):
+            result["date_posted"] = result["date_posted"].strftime('%Y-%m-%d %H:%M:%S')
+        elif result["date_posted"] is not None:
+            result["date_posted"] = str(result["date_posted"])[:19]
+    return jsonify(page)
+
+# rebuilds the forum search index of an existing database: flask --app app rebuild-search-index
+@app.cli.command("rebuild-search-index")
+def rebuild_search_index():
+    db.rebuild_search_index()
+
+# recomputes the comment count and last comment time of every article: flask --app app repair-comment-counters
+@app.cli.command("repair-comment-counters")
+def repair_comment_counters():
+    db.repair_comment_counters()
+
+# streams the database out as json lines: flask --app app export-data backup.ndjson.gz
+@app.cli.command("export-data")
+@click.argument("path")
+@click.option("--table", "tables", multiple=True, help="Only export this table, can be repeated.")
+@click.option("--chunk-size", default=10000, show_default=True, help="Rows read per fetch.")
+def export_data(path, tables, chunk_size):
+    rows = bulk.export_data(path, tables, chunk_size)
+    print(f"Exported {rows} rows.", file=sys.stderr)
+
+# loads a file written by export-data: flask --app app import-data backup.ndjson.gz
+@app.cli.command("import-data")
+@click.argument("path")
+@click.option("--table", "tables", multiple=True, help="Only import this table, can be repeated.")
+@click.option("--chunk-size", default=10000, show_default=True, help="Rows inserted per transaction.")
+def import_data(path, tables, chunk_size):
+    rows = bulk.import_data(path, tables, chunk_size)
+    print(f"Imported {rows} rows.", file=sys.stderr)
 
 @app.route("/forum/create")
 def create_article():
@@ -264,30 +468,30 @@ def submit_comment():
     db.add_comment(article_id, username, content)
     return url_for('forum')
 
+# the comments of an article, served from the cached thread
+# the ETag changes whenever a comment is added or deleted, so clients revalidate and usually get a 304,
+# pass since_comment_id to get only the comments posted after that one
 @app.route("/forum/comments")
 def get_article_comments():
 
-    article_id = request.args.get("article_id")
+    article_id = request.args.get("article_id", type=int)
     if article_id is None:
         return jsonify({"error": "Article ID is required"}), 400
+    since_comment_id = request.args.get("since_comment_id", type=int)
 
-    # Assuming db.get_comments returns a list of comments for the given article ID
-    comments = db.get_comments(article_id)
-
-    comments_data = []
-    for comment in comments:
-        comment_dict = {
-            'comment_id': comment.comment_id,
-            'author_id': comment.author_id,
-            'date_posted': comment.date_posted.strftime('%Y-%m-%d %H:%M:%S'),  # Assuming date_posted is a datetime object
-            'content': comment.content
-        }
-        if comment_dict:
-            comments_data.append(comment_dict)
-
-    comments_json = json.dumps(comments_data)
+    thread = db.get_comment_thread(article_id)
+    if thread is None:
+        return jsonify({"error": "Comments could not be loaded"}), 500
 
-    return comments_json
+    if request.if_none_match.contains(thread.etag):
+        response = app.response_class(status=304)
+    elif since_comment_id is None:
+        response = app.response_class(thread.body, mimetype="application/json")
+    else:
+        response = app.response_class(thread.since(since_comment_id), mimetype="application/json")
+    response.set_etag(thread.etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
 
 @app.route("/forum/commentdelete")
 def delete_comment():
@@ -341,6 +545,14 @@ def staff_account():
     return url_for('friends')
 
 
+# query, route and socket event metrics in the prometheus text format, only served to local clients
+@app.route('/metrics')
+def metrics_endpoint():
+    if not config.METRICS_ENABLED or request.remote_addr not in ("127.0.0.1", "::1"):
+        abort(404)
+    return app.response_class(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+# health probe for load balancers, pages use their socket to notice the server going away
 @app.route('/heartbeat')
 def heartbeat():
     # Endpoint to indicate server is running
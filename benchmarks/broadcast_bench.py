@@ -0,0 +1,96 @@
+'''
+broadcast_bench
+compares sending room messages one packet each with sending them through the RoomBroadcaster
+
+runs an in-process socket.io server with test clients, so it measures the server side cost
+of the fan-out (encoding and queueing packets), not the network
+    python benchmarks/broadcast_bench.py [--members 10 100 1000] [--messages 1000] [--window 0.01]
+'''
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from flask import Flask
+from flask_socketio import SocketIO, join_room
+
+from broadcast import RoomBroadcaster
+
+
+def create_server():
+    app = Flask(__name__)
+    app.config["SECRET_KEY"] = "benchmark"
+    socketio = SocketIO(app)
+
+    @socketio.on("join")
+    def join(room):
+        join_room(room)
+
+    return app, socketio
+
+
+def connect_members(app, socketio, members: int, room: str):
+    clients = []
+    for _ in range(members):
+        client = socketio.test_client(app)
+        client.emit("join", room)
+        client.get_received()
+        clients.append(client)
+    return clients
+
+
+def count_packets(clients):
+    return sum(len(client.get_received()) for client in clients)
+
+
+def bench_per_message(app, socketio, members: int, messages: int):
+    clients = connect_members(app, socketio, members, "per-message")
+    start = time.perf_counter()
+    for i in range(messages):
+        socketio.emit("incoming", f"user: message {i}", to="per-message")
+    elapsed = time.perf_counter() - start
+    packets = count_packets(clients)
+    for client in clients:
+        client.disconnect()
+    return elapsed, packets
+
+
+def bench_batched(app, socketio, members: int, messages: int, window: float, max_batch: int):
+    clients = connect_members(app, socketio, members, "batched")
+    broadcaster = RoomBroadcaster(socketio, window=window, max_batch=max_batch)
+    start = time.perf_counter()
+    for i in range(messages):
+        broadcaster.publish("batched", "incoming", f"user: message {i}")
+    broadcaster.close()
+    elapsed = time.perf_counter() - start
+    packets = count_packets(clients)
+    for client in clients:
+        client.disconnect()
+    return elapsed, packets
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--window", type=float, default=0.01)
+    parser.add_argument("--max-batch", type=int, default=100)
+    args = parser.parse_args()
+
+    app, socketio = create_server()
+    print(f"{args.messages} messages per room, batch window {args.window * 1000:g} ms, up to {args.max_batch} per frame")
+    print(f"{'members':>8} {'mode':>12} {'seconds':>9} {'msgs/s':>10} {'packets':>9}")
+    for members in args.members:
+        for mode, run in (
+            ("per-message", lambda: bench_per_message(app, socketio, members, args.messages)),
+            ("batched", lambda: bench_batched(app, socketio, members, args.messages, args.window, args.max_batch)),
+        ):
+            elapsed, packets = run()
+            print(f"{members:>8} {mode:>12} {elapsed:>9.3f} {args.messages / elapsed:>10.0f} {packets:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+'''
+db_bench
+times the public db.py functions against synthetic sqlite databases, and counts the queries each call runs
+
+for every size a database is built with that many friendship, participant, message and comment rows,
+a tenth as many users and a hundredth as many articles, then every function is called --repeat times
+with the lookup caches cleared before each call, so the query counts show the real query shape
+    python benchmarks/db_bench.py [--sizes 10000 100000 1000000] [--repeat 20] [--output db_bench.json]
+
+the results are written as JSON, pass an earlier file as --compare to see what changed since then,
+the exit status is 1 if any function runs more queries per call than it did in the compared run
+'''
+
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# public db.py functions that aren't timed: engine and schema setup, unit of work plumbing,
+# cache helpers, pure functions without queries, and the one off admin account
+NOT_BENCHMARKED = {
+    "set_sqlite_pragmas", "create_db_engine", "dialect_insert", "migrate_association_table",
+    "dedupe_association_table", "drop_obsolete_indexes",
+    "add_missing_columns", "create_missing_indexes", "search_index_enabled", "create_search_index",
+    "search_index_suspended", "get_session", "current_unit_of_work", "begin_unit_of_work",
+    "end_unit_of_work", "unit_of_work", "on_commit", "cache_on_commit", "publish_invalidation", "count_query", "calling_function", "record_query",
+    "invalidate_membership",
+    "invalidate_comment_thread", "membership_cache_stats", "cache_stats", "encode_article_cursor",
+    "decode_article_cursor", "build_search_query", "create_admin_user",
+}
+
+PASSWORD = "benchmark-password"
+CATEGORIES = ["general", "maths", "physics", "computing", "history"]
+WORDS = ["lecture", "assignment", "exam", "tutorial", "project", "deadline", "notes", "question", "answer", "lab"]
+CHUNK_SIZE = 10000
+
+
+def username(i):
+    return f"user{i}"
+
+
+def text(rng, words=12):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+# the row counts of a database of the given size
+def shape(size):
+    users = max(100, size // 10)
+    return {
+        "users": users,
+        # each user has 5 friends, stored as 2 rows per friendship
+        "friends_per_user": 5,
+        # a private room for every user and the next one, the other participants are in groups of 50
+        "groups": max(1, (size - 2 * users) // 50),
+        "group_size": 50,
+        "messages": size,
+        "articles": max(10, size // 100),
+        "comments": size,
+    }
+
+
+def insert_chunks(connection, table, rows):
+    rows = iter(rows)
+    count = 0
+    while True:
+        chunk = list(itertools.islice(rows, CHUNK_SIZE))
+        if not chunk:
+            return count
+        connection.execute(table.insert(), chunk)
+        count += len(chunk)
+
+
+def build_database(db, models, hashing, size, rng):
+    s = shape(size)
+    users = s["users"]
+    salt = "0" * 32
+    password = hashing.pool.hash(PASSWORD, salt, db.config.PASSWORD_HASH_ALGORITHM, db.config.PASSWORD_HASH_ITERATIONS)
+    private_rooms = users
+    rooms = private_rooms + s["groups"]
+    start = datetime(2024, 1, 1)
+    rows = {}
+
+    with db.search_index_suspended(), db.engine.begin() as connection:
+        rows["user"] = insert_chunks(connection, models.User.__table__, (
+            {"username": username(i), "password": password, "salt": salt,
+             "hash_algorithm": db.config.PASSWORD_HASH_ALGORITHM,
+             "hash_iterations": db.config.PASSWORD_HASH_ITERATIONS,
+             "online_status": i % 3 == 0, "role": "student", "post": True, "chat": True}
+            for i in range(users)))
+        rows["friends"] = insert_chunks(connection, models.association_table, (
+            row
+            for i in range(users) for d in range(1, s["friends_per_user"] + 1)
+            for row in ({"user_id": username(i), "friend_id": username((i + d) % users)},
+                        {"user_id": username((i + d) % users), "friend_id": username(i)})))
+        # every user has a pending request from the user 7 before them
+        rows["friend_request"] = insert_chunks(connection, models.FriendRequest.__table__, (
+            {"sender_id": username(i), "recipient_id": username((i + 7) % users), "accepted": False}
+            for i in range(users)))
+        rows["room"] = insert_chunks(connection, models.Room.__table__, itertools.chain(
+            ({"room_id": i + 1, "room_name": username(i) + username((i + 1) % users), "is_group": False,
+              "room_salt": f"{i:032x}"} for i in range(private_rooms)),
+            ({"room_id": private_rooms + g + 1, "room_name": f"group{g}", "is_group": True,
+              "room_salt": f"{g:032x}"} for g in range(s["groups"]))))
+        rows["participant"] = insert_chunks(connection, models.Participant.__table__, itertools.chain(
+            ({"username": username((i + k) % users), "room_id": i + 1} for i in range(private_rooms) for k in (0, 1)),
+            ({"username": username((g * s["group_size"] + k) % users), "room_id": private_rooms + g + 1}
+             for g in range(s["groups"]) for k in range(s["group_size"]))))
+        rows["message_decryption_keys"] = insert_chunks(connection, models.MessageDecryptionKeys.__table__, (
+            {"username": username(i), "room_id": i + 1, "encrypted_key": f"key{i}"} for i in range(private_rooms)))
+        rows["message_history"] = insert_chunks(connection, models.MessageHistory.__table__, (
+            {"room_id": rng.randint(1, rooms), "encrypted_message": f"{username(rng.randrange(users))}: {text(rng)}"}
+            for _ in range(s["messages"])))
+        rows["article"] = insert_chunks(connection, models.Article.__table__, (
+            {"article_id": a + 1, "author_id": username(rng.randrange(users)), "title": f"Article {a + 1}",
+             "content": text(rng, 80), "date_posted": start + timedelta(minutes=a),
+             "category": CATEGORIES[a % len(CATEGORIES)]}
+            for a in range(s["articles"])))
+        rows["comment"] = insert_chunks(connection, models.Comment.__table__, (
+            {"article_id": rng.randint(1, s["articles"]), "author_id": username(rng.randrange(users)),
+             "content": text(rng), "date_posted": start + timedelta(minutes=c)}
+            for c in range(s["comments"])))
+    db.repair_comment_counters()
+    return rows
+
+
+# name -> (function, arguments for the k-th call, number of calls or None for --repeat)
+# calls that change rows get arguments no earlier call touched
+def benchmarks(db, size, rng):
+    s = shape(size)
+    users = s["users"]
+    private_rooms = users
+    rooms = private_rooms + s["groups"]
+    user = lambda: username(rng.randrange(users))
+    room = lambda: rng.randint(1, rooms)
+    group = lambda: f"group{rng.randrange(s['groups'])}"
+    article = lambda: rng.randint(1, s["articles"])
+    # a user and one of their friends
+    friend = lambda i: (username(i % users), username((i + 1) % users))
+    # pairs that aren't friends and have no request between them, k-th pair for the k-th call
+    stranger = lambda k: (username(k % users), username((k + 20) % users))
+    return {
+        "insert_user": (db.insert_user, lambda k: (f"new_user{k}", PASSWORD), 3),
+        "rehash_password": (db.rehash_password, lambda k: (username(k), PASSWORD), 3),
+        "get_user": (db.get_user, lambda k: (user(),), None),
+        "are_friends": (db.are_friends, lambda k: friend(rng.randrange(users)), None),
+        "insert_friend": (db.insert_friend, lambda k: stranger(k), None),
+        "remove_friend": (db.remove_friend, lambda k: friend(k * 3), None),
+        "add_friendship": (db.add_friendship, lambda k: stranger(k + users // 2), None),
+        "accept_friend_request": (db.accept_friend_request,
+                                  lambda k: (username((k * 2 + 7) % users), username(k * 2)), None),
+        "remove_friendship": (db.remove_friendship, lambda k: friend(k * 3 + 1), None),
+        "get_friends": (db.get_friends, lambda k: (user(),), None),
+        "get_mutual_friends": (db.get_mutual_friends, lambda k: friend(rng.randrange(users)), None),
+        "suggest_friends": (db.suggest_friends, lambda k: (user(),), None),
+        "get_profile": (db.get_profile, lambda k: (user(),), None),
+        "get_friends_many": (db.get_friends_many, lambda k: ([user() for _ in range(50)],), None),
+        "send_request": (db.send_request, lambda k: stranger(k + users // 4), None),
+        "get_requests": (db.get_requests, lambda k: (user(),), None),
+        "delete_requests": (db.delete_requests, lambda k: (username(k * 2 + 1), username((k * 2 + 8) % users)), None),
+        "insert_encryption_key": (db.insert_encryption_key, lambda k: (user(), room(), f"new_key{k}"), None),
+        "get_encryption_key": (db.get_encryption_key, lambda k: (user(), room()), None),
+        "get_encryption_keys": (db.get_encryption_keys, lambda k: (user(),), None),
+        "store_encrypted_message": (db.store_encrypted_message, lambda k: (room(), f"new message {k}"), None),
+        "store_encrypted_messages": (db.store_encrypted_messages,
+                                     lambda k: ([(room(), f"new message {k}.{i}") for i in range(50)],), None),
+        "retrieve_encrypted_messages": (db.retrieve_encrypted_messages, lambda k: (room(),), None),
+        "retrieve_encrypted_messages_page": (db.retrieve_encrypted_messages_page, lambda k: (room(),), None),
+        "create_room": (db.create_room, lambda k: (*stranger(k + users // 3), False), None),
+        "get_room_id_by_name": (db.get_room_id_by_name, lambda k: (group(),), None),
+        "get_user_chatrooms": (db.get_user_chatrooms, lambda k: (user(),), None),
+        "get_chat_room_names": (db.get_chat_room_names, lambda k: (), 3),
+        "add_participant": (db.add_participant, lambda k: (user(), private_rooms + 1 + k % s["groups"]), None),
+        "delete_participant": (db.delete_participant, lambda k: (username(k * 2 % users), k * 2 % users + 1), None),
+        "get_participants": (db.get_participants, lambda k: (room(),), None),
+        "find_exclusive_room": (db.find_exclusive_room, lambda k: friend(rng.randrange(users)), None),
+        "change_online_status": (db.change_online_status, lambda k: (user(), k % 2 == 0), None),
+        "get_online_status": (db.get_online_status, lambda k: (user(),), None),
+        "set_online_statuses": (db.set_online_statuses,
+                                lambda k: ({user(): rng.random() < 0.5 for _ in range(50)},), None),
+        "set_all_users_offline": (db.set_all_users_offline, lambda k: (), 3),
+        "add_article": (db.add_article, lambda k: (user(), f"New article {k}", text(rng, 80), CATEGORIES[0]), None),
+        "delete_article": (db.delete_article, lambda k: (s["articles"] - k,), None),
+        "edit_article": (db.edit_article, lambda k: (article(), text(rng, 80)), None),
+        "get_article": (db.get_article, lambda k: (article(),), None),
+        "get_article_by_name": (db.get_article_by_name, lambda k: (f"Article {article()}",), None),
+        "list_articles": (db.list_articles, lambda k: (), None),
+        "list_articles_hot": (lambda: db.list_articles(order="hot"), lambda k: (), None),
+        "get_articles_by_category": (db.get_articles_by_category, lambda k: (rng.choice(CATEGORIES),), None),
+        "get_all_articles": (db.get_all_articles, lambda k: (), 3),
+        "search_forum": (db.search_forum, lambda k: (rng.choice(WORDS),), None),
+        "get_comment_thread": (db.get_comment_thread, lambda k: (article(),), None),
+        "get_comments": (db.get_comments, lambda k: (article(),), None),
+        "get_all_comments": (db.get_all_comments, lambda k: (), 3),
+        "add_comment": (db.add_comment, lambda k: (article(), user(), text(rng)), None),
+        "delete_comment": (db.delete_comment, lambda k: (k + 1,), None),
+        "change_user_role": (db.change_user_role, lambda k: (user(), "academic"), None),
+        "get_user_role": (db.get_user_role, lambda k: (user(),), None),
+        "mute_user_post": (db.mute_user_post, lambda k: (user(), k % 2 == 0), None),
+        "mute_user_chat": (db.mute_user_chat, lambda k: (user(), k % 2 == 0), None),
+        "rebuild_search_index": (db.rebuild_search_index, lambda k: (), 1),
+        "repair_comment_counters": (db.repair_comment_counters, lambda k: (), 1),
+    }
+
+
+def clear_caches(db, cache):
+    for value in vars(db).values():
+        if isinstance(value, cache.LRUCache):
+            value.clear()
+
+
+# times every function against one database, runs in its own process so db.py binds to that database
+def run_size(size, database, repeat, seed):
+    os.environ["DATABASE_URL"] = f"sqlite:///{database}"
+    sys.path.insert(0, REPO_DIR)
+    # db.py and its callees report with print, which would drown the results
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        import cache
+        import db
+        import hashing
+        import models
+
+        rng = random.Random(seed)
+        start = time.perf_counter()
+        rows = build_database(db, models, hashing, size, rng)
+        build_seconds = time.perf_counter() - start
+        print(f"built {size} in {build_seconds:.1f}s", file=sys.stderr)
+
+        results = {}
+        for name, (function, arguments, calls) in benchmarks(db, size, rng).items():
+            timings = []
+            queries = []
+            for k in range(calls or repeat):
+                args = arguments(k)
+                clear_caches(db, cache)
+                before = db.queries_executed
+                call_start = time.perf_counter()
+                function(*args)
+                timings.append(time.perf_counter() - call_start)
+                queries.append(db.queries_executed - before)
+            timings.sort()
+            results[name] = {
+                "calls": len(timings),
+                "mean_ms": statistics.fmean(timings) * 1000,
+                "p50_ms": timings[len(timings) // 2] * 1000,
+                "max_ms": timings[-1] * 1000,
+                "queries_per_call": statistics.fmean(queries),
+                "max_queries": max(queries),
+            }
+        covered = {getattr(function, "__name__", name) for function, _, _ in benchmarks(db, size, rng).values()}
+        public = {name for name, value in vars(db).items()
+                  if callable(value) and getattr(value, "__module__", None) == "db"
+                  and not name.startswith("_") and not isinstance(value, type)}
+        missing = sorted(public - covered - NOT_BENCHMARKED)
+    return {"build_seconds": build_seconds, "rows": rows, "functions": results, "missing": missing}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    regressions = []
+    for size, result in results["sizes"].items():
+        old_functions = (baseline or {}).get("sizes", {}).get(size, {}).get("functions", {})
+        print(f"\n{size} rows, built in {result['build_seconds']:.1f}s")
+        print(f"{'function':<34} {'calls':>5} {'mean ms':>10} {'p50 ms':>10} {'max ms':>10} {'queries':>8}"
+              + ("  change" if baseline else ""))
+        for name, r in result["functions"].items():
+            line = (f"{name:<34} {r['calls']:>5} {r['mean_ms']:>10.2f} {r['p50_ms']:>10.2f} {r['max_ms']:>10.2f}"
+                    f" {r['queries_per_call']:>8.1f}")
+            old = old_functions.get(name)
+            if old:
+                line += f"  {(r['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100:+.0f}% time" if old["p50_ms"] else ""
+                if r["queries_per_call"] > old["queries_per_call"]:
+                    line += f", queries {old['queries_per_call']:.1f} -> {r['queries_per_call']:.1f}"
+                    regressions.append(f"{name} at {size} rows")
+            print(line)
+        if result["missing"]:
+            print("public functions without a benchmark:", ", ".join(result["missing"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=20, help="calls per function")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="directory for the databases, a temporary one by default")
+    parser.add_argument("--output", default="db_bench.json", help="JSON file for the results")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    # runs a single size, used by the subprocesses
+    parser.add_argument("--run-size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--database", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_size is not None:
+        result = run_size(args.run_size, args.database, args.repeat, args.seed)
+        with open(args.result, "w") as f:
+            json.dump(result, f)
+        return
+
+    results = {"commit": git_commit(), "date": datetime.now().isoformat(timespec="seconds"),
+               "repeat": args.repeat, "seed": args.seed, "sizes": {}}
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        for size in args.sizes:
+            database = os.path.join(workdir, f"bench_{size}.db")
+            result = os.path.join(workdir, f"bench_{size}.json")
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--run-size", str(size),
+                            "--database", database, "--result", result,
+                            "--repeat", str(args.repeat), "--seed", str(args.seed)],
+                           stdout=subprocess.DEVNULL, check=True)
+            with open(result) as f:
+                results["sizes"][str(size)] = json.load(f)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    regressions = print_results(results, baseline)
+    if regressions:
+        print("\nmore queries per call than in", args.compare + ":", ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+'''
+load_test
+simulates users of the app end to end, over HTTPS and socket.io, and reports throughput and latency
+
+each simulated user signs up, logs in, opens /chat, joins a room with another simulated user and a group,
+then repeatedly sends messages (send + store_encrypted_message), reads the room history
+(get_encrypted_messages), and browses /forum and /forum/comments, with a think time between steps
+    python benchmarks/load_test.py --start-server [--users 50] [--concurrency 50] [--iterations 20] [--think 1.0]
+
+--start-server runs app.py on a separate database (database/loadtest.db), otherwise the test runs against
+the server at --url. the self-signed certificate isn't verified, so it runs offline.
+pass --output to save the report as JSON and --baseline to compare a run against a saved one.
+needs the socket.io client dependencies, see benchmarks/requirements.txt
+'''
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import socketio
+import urllib3
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# the app serves a self-signed certificate
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+ARTICLE_ID = re.compile(r"showArticleDetails\('(\d+)'\)")
+
+
+class LoadTestError(Exception):
+    pass
+
+
+# latencies and errors of every operation, by event or route name
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.started = time.perf_counter()
+        self.finished = None
+
+    # runs call and records how long it took, check says whether the result is a success
+    def timed(self, name, call, check=None):
+        start = time.perf_counter()
+        try:
+            result = call()
+        except Exception as e:
+            with self.lock:
+                self.errors[name] += 1
+            raise LoadTestError(f"{name}: {e!r}") from e
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latencies[name].append(elapsed)
+            if check is not None and not check(result):
+                self.errors[name] += 1
+                raise LoadTestError(f"{name}: unexpected result {result!r}")
+        return result
+
+    def stop(self):
+        self.finished = time.perf_counter()
+
+    def report(self):
+        duration = (self.finished or time.perf_counter()) - self.started
+        operations = {}
+        for name in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies[name])
+            operations[name] = {
+                "count": len(values),
+                "errors": self.errors[name],
+                "rate": len(values) / duration,
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+            }
+        total = sum(op["count"] for op in operations.values())
+        return {"duration": duration, "total": total, "rate": total / duration, "operations": operations}
+
+
+# nearest-rank percentile of sorted values, in milliseconds
+def percentile(values, p):
+    if not values:
+        return None
+    index = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[index] * 1000
+
+
+def format_ms(value):
+    return "-" if value is None else f"{value:.1f}"
+
+
+def format_change(value, baseline):
+    if value is None or not baseline:
+        return ""
+    return f" ({(value - baseline) / baseline * 100:+.0f}%)"
+
+
+def print_report(report, baseline=None):
+    baseline_operations = (baseline or {}).get("operations", {})
+    print(f"{report['total']} operations in {report['duration']:.1f}s, {report['rate']:.1f}/s"
+          + format_change(report["rate"], (baseline or {}).get("rate")))
+    print(f"{'operation':<32} {'count':>7} {'errors':>6} {'rate/s':>8} {'p50 ms':>16} {'p95 ms':>16} {'p99 ms':>16}")
+    for name, op in report["operations"].items():
+        old = baseline_operations.get(name, {})
+        print(f"{name:<32} {op['count']:>7} {op['errors']:>6} {op['rate']:>8.1f}"
+              + "".join(f" {format_ms(op[p]) + format_change(op[p], old.get(p)):>16}" for p in ("p50", "p95", "p99")))
+
+
+class User:
+    def __init__(self, args, stats: Stats, index: int):
+        self.args = args
+        self.stats = stats
+        self.username = f"{args.prefix}{index}"
+        # talks with the next simulated user
+        self.partner = f"{args.prefix}{(index + 1) % args.users}"
+        self.http = requests.Session()
+        self.http.verify = False
+        # the server is local, ignore proxies and CA bundles from the environment
+        self.http.trust_env = False
+        self.socket = None
+        # article_id -> ETag of its comments, revalidated like the browser does
+        self.comment_etags = {}
+        self.article_ids = []
+
+    def think(self):
+        if self.args.think > 0:
+            time.sleep(random.uniform(0.5, 1.5) * self.args.think)
+
+    def post(self, route, data):
+        response = self.stats.timed(
+            f"POST {route}", lambda: self.http.post(self.args.url + route, json=data, timeout=self.args.timeout),
+            check=lambda r: r.ok)
+        if response.text.startswith("Error"):
+            raise LoadTestError(f"POST {route}: {response.text}")
+        return response
+
+    def get(self, route, params=None, headers=None):
+        return self.stats.timed(
+            f"GET {route}",
+            lambda: self.http.get(self.args.url + route, params=params, headers=headers, timeout=self.args.timeout),
+            check=lambda r: r.status_code < 400)
+
+    def call(self, event, *data):
+        return self.stats.timed(event, lambda: self.socket.call(event, data, timeout=self.args.timeout))
+
+    def signup(self):
+        # users left over from an earlier run already exist, they log in with the same password
+        self.stats.timed(
+            "POST /signup/user",
+            lambda: self.http.post(self.args.url + "/signup/user", timeout=self.args.timeout,
+                                   json={"username": self.username, "password": self.args.password}),
+            check=lambda r: r.ok and (not r.text.startswith("Error") or r.text == "Error: User already exists!"))
+
+    def login(self):
+        self.post("/login/user", {"username": self.username, "password": self.args.password})
+
+    def connect(self):
+        self.socket = socketio.Client(http_session=self.http, ssl_verify=False)
+        self.stats.timed("socket connect", lambda: self.socket.connect(self.args.url, wait_timeout=self.args.timeout))
+
+    def join_rooms(self):
+        self.room_id = self.call("join", self.username, self.partner)
+        if not isinstance(self.room_id, int):
+            raise LoadTestError(f"join: {self.room_id!r}")
+        group_id = self.call("join_group", self.username, self.args.group)
+        if group_id is None:
+            # the first user to get here creates the group, the others join it
+            self.call("create_group", self.username, self.args.group)
+            self.call("join_group", self.username, self.args.group)
+
+    def chat(self, i):
+        message = f"message {i} from {self.username}"
+        self.call("send", self.username, message, self.room_id)
+        self.call("store_encrypted_message", self.room_id, f"{self.username}: {message}")
+
+    def read_history(self):
+        self.call("get_encrypted_messages", self.room_id)
+
+    def browse_forum(self):
+        page = self.get("/forum")
+        self.article_ids = ARTICLE_ID.findall(page.text) or self.article_ids
+        if not self.article_ids:
+            return
+        article_id = random.choice(self.article_ids)
+        headers = {}
+        if article_id in self.comment_etags:
+            headers["If-None-Match"] = self.comment_etags[article_id]
+        response = self.get("/forum/comments", params={"article_id": article_id}, headers=headers)
+        if "ETag" in response.headers:
+            self.comment_etags[article_id] = response.headers["ETag"]
+
+    def run(self):
+        try:
+            self.login()
+            self.get("/chat", params={"username": self.username})
+            self.connect()
+            self.join_rooms()
+        except LoadTestError as e:
+            print(f"{self.username} could not start: {e}", file=sys.stderr)
+            self.close()
+            return
+
+        steps = [self.chat, lambda i: self.read_history(), lambda i: self.browse_forum()]
+        for i in range(self.args.iterations):
+            for step in steps:
+                self.think()
+                try:
+                    step(i)
+                except LoadTestError as e:
+                    print(f"{self.username}: {e}", file=sys.stderr)
+        self.close()
+
+    def close(self):
+        if self.socket is not None and self.socket.connected:
+            self.socket.disconnect()
+        self.http.close()
+
+
+# makes sure the forum has an article whose comments the users can load
+def seed_forum(args, stats: Stats):
+    user = User(args, stats, 0)
+    user.login()
+    if not ARTICLE_ID.search(user.http.get(args.url + "/forum", timeout=args.timeout).text):
+        user.http.post(args.url + "/forum/post", timeout=args.timeout,
+                       data={"fname": "Load test", "content": "An article for the load test.", "lname": "general"})
+    user.close()
+
+
+def start_server(args):
+    env = dict(os.environ)
+    env.setdefault("DATABASE_URL", args.database_url)
+    # app.py reads its certificate from certs/ and keeps the sqlite database in database/, under server_dir
+    server = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "app.py")], cwd=args.server_dir, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit("the server exited before it started listening")
+        try:
+            with requests.Session() as http:
+                http.trust_env = False
+                if http.get(args.url + "/heartbeat", verify=False, timeout=1).ok:
+                    return server
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise SystemExit("the server did not start within 30 seconds")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="https://127.0.0.1:5000")
+    parser.add_argument("--start-server", action="store_true", help="run app.py for the duration of the test")
+    parser.add_argument("--database-url", default="sqlite:///database/loadtest.db",
+                        help="database of the started server, unless DATABASE_URL is set")
+    parser.add_argument("--server-dir", default=REPO_DIR, help="working directory of the started server")
+    parser.add_argument("--users", type=int, default=20, help="number of simulated users")
+    parser.add_argument("--concurrency", type=int, default=None, help="users active at once, all of them by default")
+    parser.add_argument("--iterations", type=int, default=10, help="times each user goes through its steps")
+    parser.add_argument("--think", type=float, default=1.0, help="mean seconds a user waits between steps")
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="seconds over which the users start")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for a response")
+    parser.add_argument("--prefix", default="loadtest_", help="username prefix of the simulated users")
+    parser.add_argument("--password", default="LoadTest-password-1")
+    parser.add_argument("--group", default="loadtest", help="group chat every user joins")
+    parser.add_argument("--seed", type=int, default=None, help="seed for the think times and article choices")
+    parser.add_argument("--output", help="save the report as JSON")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare with")
+    args = parser.parse_args()
+    args.url = args.url.rstrip("/")
+    if args.users < 2:
+        parser.error("--users must be at least 2, the users chat with each other")
+    random.seed(args.seed)
+
+    server = start_server(args) if args.start_server else None
+    try:
+        setup = Stats()
+        # every user has to exist before they join rooms with each other
+        with ThreadPoolExecutor(max_workers=args.concurrency or args.users) as pool:
+            list(pool.map(lambda i: User(args, setup, i).signup(), range(args.users)))
+        seed_forum(args, setup)
+
+        stats = Stats()
+        users = [User(args, stats, i) for i in range(args.users)]
+
+        def start(user, i):
+            time.sleep(args.ramp_up * i / args.users)
+            user.run()
+
+        with ThreadPoolExecutor(max_workers=args.concurrency or args.users) as pool:
+            list(pool.map(start, users, range(args.users)))
+        stats.stop()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(setup.report())
+    print()
+    report = stats.report()
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+'''
+broadcast
+batches chat messages sent to a room into one frame
+
+a busy room sends every member one packet per message, clients that opt in get the
+events of a short window in a single "incoming_batch" frame instead, as a list of
+[event, data] pairs. one thread sends every frame, with the events in the order they
+were published, so each room keeps its order
+'''
+
+from threading import Condition, Thread
+
+
+class RoomBroadcaster():
+    def __init__(self, socketio, window: float = 0.01, max_batch: int = 100, event: str = "incoming_batch"):
+        self.socketio = socketio
+        # longest time a message waits for others to share its frame, 0 sends every message straight away
+        self.window = window
+        # a room's batch is sent early once it holds this many messages
+        self.max_batch = max_batch
+        self.event = event
+        # room -> messages waiting to be sent
+        self.pending = {}
+        self.full = False
+        self.condition = Condition()
+        self.closed = False
+        self.thread = None
+        self.published = 0
+        self.frames = 0
+
+    # queues an event for every member of the room
+    def publish(self, room, event: str, data):
+        message = [event, data]
+        if self.window <= 0 or self.closed:
+            self.socketio.emit(self.event, [message], to=room)
+            with self.condition:
+                self.published += 1
+                self.frames += 1
+            return
+        with self.condition:
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name="room-broadcaster", daemon=True)
+                self.thread.start()
+            batch = self.pending.setdefault(room, [])
+            batch.append(message)
+            self.published += 1
+            if len(batch) >= self.max_batch:
+                self.full = True
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.closed)
+                if not self.pending:
+                    return
+                # give the other messages of the window time to arrive
+                self.condition.wait_for(lambda: self.full or self.closed, timeout=self.window)
+                pending, self.pending = self.pending, {}
+                self.full = False
+                self.frames += len(pending)
+            for room, batch in pending.items():
+                try:
+                    self.socketio.emit(self.event, batch, to=room)
+                except Exception as e:
+                    print("An error occurred while broadcasting to a room:", e)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "published": self.published,
+                "frames": self.frames,
+                "pending_rooms": len(self.pending),
+            }
+
+    # sends whatever is still waiting
+    def close(self, timeout: float = 5.0):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
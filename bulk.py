@@ -0,0 +1,172 @@
+'''
+bulk
+streaming export and import of the whole database, as json lines
+
+every line holds one row, {"table": ..., "row": {...}}, and the tables are written
+parents first, so a file can be imported into an empty database in one pass. rows are
+read and written in chunks, exporting or importing millions of message history rows
+takes constant memory. users keep their password hashes and salts, nothing is rehashed
+
+    flask --app app export-data backup.ndjson.gz
+    flask --app app import-data backup.ndjson.gz
+'''
+
+from datetime import datetime
+import base64
+import gzip
+import sys
+import time
+
+from sqlalchemy import select, DateTime, LargeBinary
+
+import db
+import jsonenc
+from models import Base
+
+# progress is printed every this many rows of a table
+REPORT_EVERY = 100000
+
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+def _tables(names=None):
+    tables = Base.metadata.sorted_tables
+    if not names:
+        return tables
+    unknown = set(names) - {table.name for table in tables}
+    if unknown:
+        raise ValueError(f"Unknown tables: {', '.join(sorted(unknown))}")
+    return [table for table in tables if table.name in names]
+
+# converts a column value to json and back, for the types json has no notation for
+def _encoder(column_type):
+    if isinstance(column_type, LargeBinary):
+        return lambda value: None if value is None else base64.b64encode(value).decode("ascii")
+    if isinstance(column_type, DateTime):
+        return lambda value: None if value is None else value.isoformat()
+    return None
+
+def _decoder(column_type):
+    if isinstance(column_type, LargeBinary):
+        return lambda value: None if value is None else base64.b64decode(value)
+    if isinstance(column_type, DateTime):
+        return lambda value: None if value is None else datetime.fromisoformat(value)
+    return None
+
+
+class Progress():
+    def __init__(self, action: str, table: str):
+        self.action = action
+        self.table = table
+        self.rows = 0
+        self.start = time.perf_counter()
+
+    def add(self, rows: int):
+        before = self.rows
+        self.rows += rows
+        if self.rows // REPORT_EVERY > before // REPORT_EVERY:
+            self.report("...")
+
+    def report(self, suffix: str = ""):
+        elapsed = time.perf_counter() - self.start
+        rate = self.rows / elapsed if elapsed > 0 else 0.0
+        print(f"{self.action} {self.table}: {self.rows} rows in {elapsed:.1f} s ({rate:.0f} rows/s){suffix}",
+              file=sys.stderr)
+
+
+# writes every row of the tables to path, a .gz path is compressed
+def export_data(path: str, tables=None, chunk_size: int = 10000):
+    total = 0
+    with _open(path, "wb") as out:
+        for table in _tables(tables):
+            # names are quoted_name, a str subclass orjson doesn't take as a key
+            encoders = [(str(column.name), _encoder(column.type)) for column in table.columns]
+            table_name = str(table.name)
+            progress = Progress("Exported", table.name)
+            order = list(table.primary_key.columns) or list(table.columns)
+            with db.engine.connect() as connection:
+                result = connection.execution_options(stream_results=True, yield_per=chunk_size) \
+                    .execute(select(table).order_by(*order))
+                for rows in result.partitions():
+                    lines = []
+                    for row in rows:
+                        mapping = row._mapping
+                        values = {}
+                        for name, encode in encoders:
+                            value = mapping[name]
+                            values[name] = encode(value) if encode is not None else value
+                        lines.append(jsonenc.dumps({"table": table_name, "row": values}))
+                    lines.append(b"")
+                    out.write(b"\n".join(lines))
+                    progress.add(len(rows))
+            progress.report()
+            total += progress.rows
+    return total
+
+# inserts the rows of an exported file, chunk_size rows per statement and transaction
+# rows whose primary key already exists are skipped, so an interrupted import can be run again
+def import_data(path: str, tables=None, chunk_size: int = 10000):
+    wanted = {table.name for table in _tables(tables)}
+    known = {table.name: table for table in Base.metadata.sorted_tables}
+    total = 0
+    table = None
+    decoders = []
+    chunk = []
+    progress = None
+    # the search index is rebuilt once at the end instead of row by row
+    with _open(path, "rb") as source, db.search_index_suspended(), db.engine.connect() as connection:
+        def flush():
+            if chunk:
+                connection.execute(db.dialect_insert(table).on_conflict_do_nothing(), chunk)
+                connection.commit()
+                progress.add(len(chunk))
+                chunk.clear()
+
+        for number, line in enumerate(source, 1):
+            if not line.strip():
+                continue
+            record = jsonenc.loads(line)
+            name = record["table"]
+            if name not in known:
+                raise ValueError(f"Line {number}: unknown table '{name}'")
+            if name not in wanted:
+                continue
+            if table is None or name != table.name:
+                flush()
+                if progress is not None:
+                    progress.report()
+                    total += progress.rows
+                table = known[name]
+                decoders = [(column.name, decoder) for column in table.columns
+                            if (decoder := _decoder(column.type)) is not None]
+                progress = Progress("Imported", name)
+            row = record["row"]
+            for column, decode in decoders:
+                if column in row:
+                    row[column] = decode(row[column])
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                flush()
+        flush()
+        if progress is not None:
+            progress.report()
+            total += progress.rows
+        if db.engine.dialect.name == "postgresql":
+            _reset_sequences(connection)
+    return total
+
+# rows were inserted with their ids, move the id sequences past them
+def _reset_sequences(connection):
+    quote = connection.dialect.identifier_preparer.quote
+    for table in Base.metadata.sorted_tables:
+        column = table.autoincrement_column
+        if column is None:
+            continue
+        connection.exec_driver_sql(
+            f"SELECT setval(pg_get_serial_sequence('{quote(table.name)}', '{column.name}'), "
+            f"COALESCE((SELECT MAX({quote(column.name)}) FROM {quote(table.name)}), 1))"
+        )
+    connection.commit()
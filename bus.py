@@ -0,0 +1,90 @@
+'''
+bus
+publish/subscribe bus used to share state between app nodes
+
+LocalBus delivers messages inside the current process, which is all a single node needs
+and is what tests run against. RedisBus delivers them to every node connected to the
+same redis server, set PUBSUB_URL=redis://host:6379/0 to use it
+'''
+
+from threading import Lock
+import json
+import uuid
+
+import config
+
+# identifies this process on the bus, messages carry the node they came from
+NODE_ID = uuid.uuid4().hex
+
+
+class LocalBus():
+    def __init__(self):
+        self.handlers = {}
+        self.lock = Lock()
+
+    # calls handler(message) for every message published on the channel
+    def subscribe(self, channel: str, handler):
+        with self.lock:
+            self.handlers.setdefault(channel, []).append(handler)
+
+    def publish(self, channel: str, message: dict):
+        with self.lock:
+            handlers = list(self.handlers.get(channel, ()))
+        for handler in handlers:
+            try:
+                handler(message)
+            except Exception as e:
+                print(f"An error occurred while handling a message on '{channel}':", e)
+
+    def close(self):
+        pass
+
+
+class RedisBus():
+    def __init__(self, url: str, prefix: str = "chat:"):
+        # redis is only needed when running several nodes
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self.prefix = prefix
+        self.handlers = {}
+        self.lock = Lock()
+        self.thread = None
+
+    def subscribe(self, channel: str, handler):
+        with self.lock:
+            first = channel not in self.handlers
+            self.handlers.setdefault(channel, []).append(handler)
+        if first:
+            self.pubsub.subscribe(**{self.prefix + channel: self._dispatch})
+        if self.thread is None:
+            self.thread = self.pubsub.run_in_thread(sleep_time=0.1, daemon=True)
+
+    def publish(self, channel: str, message: dict):
+        self.redis.publish(self.prefix + channel, json.dumps(message))
+
+    def _dispatch(self, raw):
+        channel = raw["channel"].decode("utf-8")[len(self.prefix):]
+        message = json.loads(raw["data"])
+        with self.lock:
+            handlers = list(self.handlers.get(channel, ()))
+        for handler in handlers:
+            try:
+                handler(message)
+            except Exception as e:
+                print(f"An error occurred while handling a message on '{channel}':", e)
+
+    def close(self):
+        if self.thread is not None:
+            self.thread.stop()
+        self.pubsub.close()
+
+
+def create_bus(url: str = config.PUBSUB_URL):
+    if not url or url.startswith("local://"):
+        return LocalBus()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBus(url)
+    raise ValueError(f"Unsupported pub/sub url: {url}")
+
+bus = create_bus()
@@ -0,0 +1,52 @@
+'''
+cache
+small thread safe LRU cache used to keep hot, rarely changing lookups out of the database
+'''
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache():
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # returns the cached value, or default if the key is not cached
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    # drops every entry for which predicate(key, value) is true
+    def invalidate_where(self, predicate):
+        with self.lock:
+            for key in [k for k, v in self.entries.items() if predicate(k, v)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "maxsize": self.maxsize,
+                    "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,89 @@
+'''
+config
+server settings, every value can be overridden with an environment variable of the same name
+'''
+
+import os
+
+
+def _env_int(name: str, default: int):
+    value = os.environ.get(name)
+    return default if value is None or value == "" else int(value)
+
+def _env_float(name: str, default: float):
+    value = os.environ.get(name)
+    return default if value is None or value == "" else float(value)
+
+def _env_bool(name: str, default: bool):
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+# "database/main.db" is the default database file, point DATABASE_URL elsewhere to change it
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///database/main.db")
+
+# set DB_ECHO=1 to display the sql output
+DB_ECHO = _env_bool("DB_ECHO", False)
+
+# query, route and socket event metrics, served on /metrics to local clients, METRICS_ENABLED=0 turns them off
+METRICS_ENABLED = _env_bool("METRICS_ENABLED", True)
+# queries taking longer than this many seconds are printed with the db.py function that ran them, 0 turns it off
+SLOW_QUERY_SECONDS = _env_float("SLOW_QUERY_SECONDS", 0.0)
+
+# connection pool, every socket handler and request checks a connection out of it
+DB_POOL_SIZE = _env_int("DB_POOL_SIZE", 10)
+DB_MAX_OVERFLOW = _env_int("DB_MAX_OVERFLOW", 20)
+DB_POOL_TIMEOUT = _env_int("DB_POOL_TIMEOUT", 30)
+DB_POOL_RECYCLE = _env_int("DB_POOL_RECYCLE", -1)
+DB_POOL_PRE_PING = _env_bool("DB_POOL_PRE_PING", False)
+
+# pragmas run on every new sqlite connection
+# WAL lets readers carry on while the message writer commits, NORMAL sync is safe in WAL mode
+SQLITE_PRAGMAS = {
+    "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": _env_int("SQLITE_BUSY_TIMEOUT", 5000),
+    "mmap_size": _env_int("SQLITE_MMAP_SIZE", 256 * 1024 * 1024),
+    "cache_size": _env_int("SQLITE_CACHE_SIZE", -64000),
+    "temp_store": os.environ.get("SQLITE_TEMP_STORE", "MEMORY"),
+}
+
+# message queue shared by every app node, e.g. redis://localhost:6379/0
+# socket.io broadcasts go through it so room emits reach clients connected to other nodes,
+# leave it unset to run a single node
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE") or None
+
+# pub/sub bus used to share presence between nodes, defaults to the socket.io message queue
+PUBSUB_URL = os.environ.get("PUBSUB_URL") or SOCKETIO_MESSAGE_QUEUE
+
+# set PRESENCE_PERSIST=0 to stop mirroring presence into the User.online_status column
+PRESENCE_PERSIST = _env_bool("PRESENCE_PERSIST", True)
+PRESENCE_PERSIST_DELAY = _env_float("PRESENCE_PERSIST_DELAY", 2.0)
+# with several nodes, each announces itself on the bus every PRESENCE_NODE_HEARTBEAT seconds,
+# the sockets of a node not heard from for PRESENCE_NODE_TIMEOUT seconds are dropped from presence
+PRESENCE_NODE_HEARTBEAT = _env_float("PRESENCE_NODE_HEARTBEAT", 10.0)
+PRESENCE_NODE_TIMEOUT = _env_float("PRESENCE_NODE_TIMEOUT", 30.0)
+# presence changes are pushed to friends in batches this many seconds apart,
+# a user going offline and back within it is not reported
+PRESENCE_NOTIFY_DELAY = _env_float("PRESENCE_NOTIFY_DELAY", 1.0)
+
+# socket liveness, the server pings every client each SOCKETIO_PING_INTERVAL seconds and closes
+# sockets that don't answer within SOCKETIO_PING_TIMEOUT, which also takes them out of presence
+SOCKETIO_PING_INTERVAL = _env_float("SOCKETIO_PING_INTERVAL", 25.0)
+SOCKETIO_PING_TIMEOUT = _env_float("SOCKETIO_PING_TIMEOUT", 20.0)
+
+# clients that opt in get the chat messages of a room in frames of up to SOCKETIO_BATCH_MAX messages,
+# sent SOCKETIO_BATCH_WINDOW seconds after the first one, set the window to 0 to send them one by one
+SOCKETIO_BATCH_WINDOW = _env_float("SOCKETIO_BATCH_WINDOW", 0.01)
+SOCKETIO_BATCH_MAX = _env_int("SOCKETIO_BATCH_MAX", 100)
+
+# password hashing, stored hashes made with other parameters are upgraded on the next login
+PASSWORD_HASH_ALGORITHM = os.environ.get("PASSWORD_HASH_ALGORITHM", "sha256")
+PASSWORD_HASH_ITERATIONS = _env_int("PASSWORD_HASH_ITERATIONS", 600000)
+# worker processes doing the hashing, 0 hashes on the calling thread
+HASH_WORKERS = _env_int("HASH_WORKERS", 2)
+# hashes running or queued at once, callers past this wait up to HASH_TIMEOUT seconds
+HASH_MAX_PENDING = _env_int("HASH_MAX_PENDING", 64)
+HASH_TIMEOUT = _env_float("HASH_TIMEOUT", 10.0)
@@ -0,0 +1,118 @@
+'''
+hashing
+password hashing, run in a small pool of worker processes
+
+pbkdf2 with 600k iterations costs a few hundred milliseconds of cpu, running it in
+worker processes keeps login and signup from starving the request and socket threads,
+and the pool bounds how many hashes run or wait at once
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+from threading import BoundedSemaphore, Lock
+import multiprocessing
+import hashlib
+import atexit
+import time
+
+import config
+
+# parameters of the hashes stored before the algorithm and iteration count were saved per user
+LEGACY_ALGORITHM = "sha256"
+LEGACY_ITERATIONS = 600000
+
+
+class HashingBusy(Exception):
+    pass
+
+
+def pbkdf2(password: str, salt: str, algorithm: str, iterations: int) -> bytes:
+    return hashlib.pbkdf2_hmac(algorithm, password.encode('utf-8'), salt.encode('utf-8'), iterations)
+
+
+class HashingPool():
+    def __init__(self, workers: int = 2, max_pending: int = 64, timeout: float = 10.0):
+        # workers=0 hashes on the calling thread
+        self.workers = workers
+        self.timeout = timeout
+        # hashes running or waiting for a worker, callers past this wait for up to timeout
+        self.slots = BoundedSemaphore(max_pending)
+        self.max_pending = max_pending
+        self.executor = None
+        self.lock = Lock()
+        self.waiting = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def _get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                # fork, spawn would re-run app.py in every worker
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("fork")
+                )
+            return self.executor
+
+    # forks the workers now, app.py calls it before anything starts a thread:
+    # a forked worker gets a copy of every lock another thread held at the time, and can hang on it
+    def start(self):
+        if self.workers > 0:
+            # a fork pool forks all its workers on the first submit
+            self._get_executor().submit(int).result()
+
+    # hashes the password in a worker process, raises HashingBusy if no slot frees up in time
+    def hash(self, password: str, salt: str, algorithm: str, iterations: int) -> bytes:
+        queued_at = time.perf_counter()
+        with self.lock:
+            self.waiting += 1
+        acquired = self.slots.acquire(timeout=self.timeout)
+        with self.lock:
+            self.waiting -= 1
+            if not acquired:
+                self.rejected += 1
+            else:
+                self.in_flight += 1
+        if not acquired:
+            raise HashingBusy("Too many passwords are being hashed, try again later")
+        try:
+            if self.workers > 0:
+                future = self._get_executor().submit(pbkdf2, password, salt, algorithm, iterations)
+                digest = future.result()
+            else:
+                digest = pbkdf2(password, salt, algorithm, iterations)
+        finally:
+            self.slots.release()
+            elapsed = time.perf_counter() - queued_at
+            with self.lock:
+                self.in_flight -= 1
+                self.completed += 1
+                self.total_latency += elapsed
+                self.max_latency = max(self.max_latency, elapsed)
+        return digest
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "waiting": self.waiting,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_latency": self.total_latency / self.completed if self.completed else 0.0,
+                "max_latency": self.max_latency,
+            }
+
+    def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+
+
+pool = HashingPool(workers=config.HASH_WORKERS, max_pending=config.HASH_MAX_PENDING,
+                   timeout=config.HASH_TIMEOUT)
+
+atexit.register(pool.close)
@@ -0,0 +1,192 @@
+'''
+message_writer
+write-behind queue for the encrypted message history
+
+socket handlers put messages on a bounded queue and return straight away,
+a background thread drains the queue and writes the messages to the database
+in batches, so a burst of messages costs one commit instead of one each
+'''
+
+from threading import Thread, Condition
+from queue import Queue, Empty, Full
+import atexit
+import time
+
+import db
+
+
+class MessageWriter():
+    def __init__(self, max_queue: int = 10000, batch_size: int = 500, flush_interval: float = 0.05):
+        self.queue = Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        # longest time a message waits in the queue before its batch is written
+        self.flush_interval = flush_interval
+        self.condition = Condition()
+        self.submitted = 0
+        # rows put on the queue, and the rows the background thread is done with, written or failed
+        self.queued = 0
+        self.processed = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        # rows that failed to be written, failed also counts the rows submit rejected
+        self.lost = 0
+        # room_id -> [rows submitted, rows processed], for the rooms with rows still queued
+        self.rooms = {}
+        self.batches = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+        self.closed = False
+        self.thread = Thread(target=self._run, name="message-writer", daemon=True)
+        self.thread.start()
+
+    # queues a message to be stored, blocks for up to timeout seconds while the queue is full
+    # returns False if the message is malformed or could not be queued
+    def submit(self, room_id: int, encrypted_message: str, timeout: float = 1.0):
+        if self.closed:
+            return False
+        # a bad row would fail the whole batch it is written with, so it is rejected here
+        if isinstance(room_id, str) and room_id.isdigit():
+            room_id = int(room_id)
+        if not isinstance(room_id, int) or isinstance(room_id, bool) or not isinstance(encrypted_message, str):
+            with self.condition:
+                self.failed += 1
+            print("Error occurred: malformed message rejected")
+            return False
+        # counted before the put, so the writer thread never sees a row it doesn't know about
+        with self.condition:
+            self.queued += 1
+            self.rooms.setdefault(room_id, [0, 0])[0] += 1
+        try:
+            self.queue.put((room_id, encrypted_message), timeout=timeout)
+        except Full:
+            with self.condition:
+                # done with, so flush doesn't wait for it
+                self._processed(room_id)
+                self.dropped += 1
+                self.condition.notify_all()
+            print("Error occurred: message queue is full")
+            return False
+        with self.condition:
+            self.submitted += 1
+        return True
+
+    # blocks until every message queued before the call has been written, or only the messages
+    # of room_id, which returns straight away when none of them are queued
+    # returns False if it timed out or a message failed to be written in the meantime
+    def flush(self, room_id: int = None, timeout: float = None):
+        with self.condition:
+            lost = self.lost
+            if room_id is None:
+                target = self.queued
+                done = self.condition.wait_for(lambda: self.processed >= target, timeout=timeout)
+            else:
+                room = self.rooms.get(room_id)
+                if room is None:
+                    return True
+                target = room[0]
+                done = self.condition.wait_for(
+                    lambda: self.rooms.get(room_id) is not room or room[1] >= target, timeout=timeout)
+            return done and self.lost == lost
+
+    # stops accepting messages and writes everything still queued
+    def close(self, timeout: float = 10.0):
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "submitted": self.submitted,
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "batches": self.batches,
+                "last_flush_latency": self.last_flush_latency,
+                "max_flush_latency": self.max_flush_latency,
+                "avg_flush_latency": self.total_flush_latency / self.batches if self.batches else 0.0,
+            }
+
+    def _run(self):
+        while True:
+            # wait for the first message of a batch, then collect more until
+            # the batch is full or the flush interval has passed
+            item = self.queue.get()
+            if item is None:
+                self._drain()
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._write(batch)
+            if stop:
+                self._drain()
+                return
+
+    # writes whatever is left in the queue, used on shutdown
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except Empty:
+                break
+            if item is not None:
+                batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        start = time.perf_counter()
+        failed = 0
+        if not db.store_encrypted_messages(batch):
+            # the batch is all or nothing, so one bad row would lose every message in it,
+            # written one at a time only the rows that fail themselves are lost
+            for room_id, encrypted_message in batch:
+                if not db.store_encrypted_message(room_id, encrypted_message):
+                    failed += 1
+        latency = time.perf_counter() - start
+        with self.condition:
+            for room_id, _ in batch:
+                self._processed(room_id)
+            self.written += len(batch) - failed
+            self.failed += failed
+            self.lost += failed
+            self.batches += 1
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            self.total_flush_latency += latency
+            self.condition.notify_all()
+
+    # counts a row of the room as done with, called holding the condition
+    def _processed(self, room_id):
+        self.processed += 1
+        room = self.rooms[room_id]
+        room[1] += 1
+        if room[1] >= room[0]:
+            del self.rooms[room_id]
+
+
+writer = MessageWriter()
+
+# registered after db's own exit hook, so it runs first and the queue
+# is written out while the database is still usable
+atexit.register(writer.close)
@@ -0,0 +1,167 @@
+'''
+metrics
+counters and latency histograms for the database, the routes and the socket events,
+rendered in the prometheus text format by the /metrics route in app.py
+
+db.py records every query against the db.py function that ran it, app.py records every
+request by route and every socket event by name, and registers a Collector for the stats()
+of the message writer, the hashing pool, the room broadcaster and the lookup caches
+'''
+
+from threading import Lock
+from time import perf_counter
+import functools
+
+# upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra: str = "") -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter():
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        # label values -> count
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Histogram():
+    def __init__(self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count per bucket, then +Inf], sum
+        self.values = {}
+        self.lock = Lock()
+
+    def observe(self, value: float, *labels):
+        with self.lock:
+            counts, total = self.values.get(labels) or ([0] * (len(self.buckets) + 1), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self.values[labels] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self.values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+# reads a component's stats() when the metrics are rendered, every numeric field becomes a metric
+# named <name>_<field>, a counter for the fields in counters and a gauge for the others
+# with labels, stats() returns label value -> fields, e.g. one entry per cache
+class Collector():
+    def __init__(self, name: str, documentation: str, stats, counters=(), labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.stats = stats
+        self.counters = set(counters)
+        self.label_names = tuple(labels)
+
+    def render(self):
+        values = self.stats()
+        if not self.label_names:
+            values = {(): values}
+        # field -> [(label values, value)]
+        fields = {}
+        for labels, stats in sorted(values.items()):
+            labels = labels if isinstance(labels, tuple) else (labels,)
+            for field, value in stats.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    fields.setdefault(field, []).append((labels, value))
+        lines = []
+        for field, series in sorted(fields.items()):
+            kind = "counter" if field in self.counters else "gauge"
+            name = f"{self.name}_{field}" + ("_total" if kind == "counter" else "")
+            lines.append(f"# HELP {name} {self.documentation}, {field.replace('_', ' ')}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series:
+                lines.append(f"{name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+db_queries = Counter("db_queries_total", "SQL statements executed, by the db.py function that ran them",
+                     labels=("function",))
+db_query_duration = Histogram("db_query_duration_seconds", "Time spent executing SQL statements, by db.py function",
+                              labels=("function",))
+db_slow_queries = Counter("db_slow_queries_total", "SQL statements slower than SLOW_QUERY_SECONDS, by db.py function",
+                          labels=("function",))
+http_requests = Counter("http_requests_total", "HTTP requests handled, by route and status",
+                        labels=("method", "route", "status"))
+http_request_duration = Histogram("http_request_duration_seconds", "Time spent handling HTTP requests, by route",
+                                  labels=("method", "route"))
+socketio_event_errors = Counter("socketio_event_errors_total", "Socket.IO event handlers that raised, by event",
+                                labels=("event",))
+socketio_event_duration = Histogram("socketio_event_duration_seconds", "Time spent handling Socket.IO events, by event",
+                                    labels=("event",))
+
+registry = [db_queries, db_query_duration, db_slow_queries, http_requests, http_request_duration,
+            socketio_event_errors, socketio_event_duration]
+
+def register(metric):
+    registry.append(metric)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# wraps every socket.io event handler registered so far, so its latency and errors are recorded
+def instrument_socketio(socketio):
+    for handlers in socketio.server.handlers.values():
+        for event, handler in handlers.items():
+            handlers[event] = _timed_event(event, handler)
+
+def _timed_event(event: str, handler):
+    @functools.wraps(handler)
+    def timed(*args):
+        start = perf_counter()
+        try:
+            return handler(*args)
+        except Exception:
+            socketio_event_errors.inc(event)
+            raise
+        finally:
+            socketio_event_duration.observe(perf_counter() - start, event)
+    return timed
@@ -10,10 +10,11 @@ Prisma docs also looks so much better in comparison
 or use SQLite, if you're not into fancy ORMs (but be mindful of Injection attacks :) )
 '''
 
-from sqlalchemy import String, Table,  Column, Integer, ForeignKey, Boolean, DateTime
+from sqlalchemy import String, Table,  Column, Integer, ForeignKey, Boolean, DateTime, Index, LargeBinary, func
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-import hashlib
 import secrets
+import config
+import hashing
 from enum import Enum
 from datetime import datetime
 
@@ -22,8 +23,11 @@ class Base(DeclarativeBase):
     pass
 
 association_table = Table('association', Base.metadata,
-    Column('user_id', Integer, ForeignKey('user.username')),
-    Column('friend_id', Integer, ForeignKey('user.username'))
+    Column('user_id', String, ForeignKey('user.username')),
+    Column('friend_id', String, ForeignKey('user.username')),
+    # unique, so a friendship row can't be stored twice, by a re-run import for example
+    Index("ix_association_user_id_friend_id", "user_id", "friend_id", unique=True),
+    Index("ix_association_friend_id_user_id", "friend_id", "user_id"),
 )
 
 
@@ -43,8 +47,12 @@ class User(Base):
     # then accessing john.username -> will give me some data of type string
     # in other words we've mapped the username Python object property to an SQL column of type String 
     username: Mapped[str] = mapped_column(String, primary_key=True)
-    password: Mapped[str] = mapped_column(String)
+    # pbkdf2 digest, kept as raw bytes
+    password: Mapped[bytes] = mapped_column(LargeBinary)
     salt: Mapped[str] = mapped_column(String)
+    # parameters the password was hashed with, None for hashes made before they were stored
+    hash_algorithm: Mapped[str] = mapped_column(String, nullable=True)
+    hash_iterations: Mapped[int] = mapped_column(Integer, nullable=True)
     online_status: Mapped[bool] = mapped_column(Boolean, default=False)
     role: Mapped[str] = mapped_column(String, default=UserRole.STUDENT.value)
     post: Mapped[bool] = mapped_column(Boolean, default=True)  # Added post column
@@ -65,17 +73,29 @@ class User(Base):
     # Relationship with DecryptionRoomMessages table
     message_decryption_keys = relationship("MessageDecryptionKeys", backref="user")
     
+    # hashing runs in the worker pool in hashing.py, it can raise hashing.HashingBusy
     def set_password(self, password: str):
         # Generate a salt
         self.salt = secrets.token_hex(16)
+        self.hash_algorithm = config.PASSWORD_HASH_ALGORITHM
+        self.hash_iterations = config.PASSWORD_HASH_ITERATIONS
         # Hash the password with the salt
-        self.password = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), self.salt.encode('utf-8'), 600000)
+        self.password = hashing.pool.hash(password, self.salt, self.hash_algorithm, self.hash_iterations)
 
     def check_password(self, password: str) -> bool:
-        # Hash the provided password using the stored salt
-        hashed_password = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), self.salt.encode('utf-8'), 600000)
+        # Hash the provided password using the stored salt and parameters
+        hashed_password = hashing.pool.hash(
+            password, self.salt,
+            self.hash_algorithm or hashing.LEGACY_ALGORITHM,
+            self.hash_iterations or hashing.LEGACY_ITERATIONS,
+        )
         # Compare the hashed passwords
-        return hashed_password == self.password
+        return secrets.compare_digest(hashed_password, self.password)
+
+    # True if the password was hashed with parameters other than the configured ones
+    def needs_rehash(self) -> bool:
+        return (self.hash_algorithm or hashing.LEGACY_ALGORITHM) != config.PASSWORD_HASH_ALGORITHM \
+            or (self.hash_iterations or hashing.LEGACY_ITERATIONS) != config.PASSWORD_HASH_ITERATIONS
 
 
 # Model to represent friend requests
@@ -87,6 +107,11 @@ class FriendRequest(Base):
     recipient_id: Mapped[str] = mapped_column(String, ForeignKey('user.username'))
     accepted: Mapped[bool] = mapped_column(Boolean, default=False)
 
+    __table_args__ = (
+        Index("ix_friend_request_sender_id_recipient_id", "sender_id", "recipient_id"),
+        Index("ix_friend_request_recipient_id_accepted", "recipient_id", "accepted"),
+    )
+
 # Table to store decryption room messages
 class MessageDecryptionKeys(Base):
     __tablename__ = "message_decryption_keys"
@@ -103,6 +128,11 @@ class MessageHistory(Base):
     room_id: Mapped[int] = mapped_column(Integer)
     encrypted_message: Mapped[str] = mapped_column(String)
 
+    # history is paged per room by message id
+    __table_args__ = (
+        Index("ix_message_history_room_id_message_id", "room_id", "message_id"),
+    )
+
 
 # stateful counter used to generate the room id
 class Counter():
@@ -131,6 +161,12 @@ class Participant(Base):
     username: Mapped[str] = mapped_column(String, ForeignKey('user.username'))
     room_id: Mapped[int] = mapped_column(Integer, ForeignKey('room.room_id'))
 
+    # membership is looked up both by room and by user
+    __table_args__ = (
+        Index("ix_participant_room_id_username", "room_id", "username"),
+        Index("ix_participant_username_room_id", "username", "room_id"),
+    )
+
 
 class Article(Base):
     __tablename__ = "article"
@@ -141,10 +177,30 @@ class Article(Base):
     content: Mapped[str] = mapped_column(String)
     date_posted: Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
     category: Mapped[str] = mapped_column(String)
+    # kept up to date by add_comment/delete_comment, db.repair_comment_counters recomputes them
+    comment_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    last_comment_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
 
     # Relationship with Comments table
     comments = relationship("Comment", backref="article")
 
+    __table_args__ = (
+        # the forum lists articles newest first, optionally by category or author
+        Index("ix_article_date_posted_article_id", "date_posted", "article_id"),
+        Index("ix_article_category_date_posted", "category", "date_posted", "article_id"),
+        Index("ix_article_author_id_date_posted", "author_id", "date_posted", "article_id"),
+        Index("ix_article_title", "title"),
+        # and by activity, most commented on or most recently commented on first
+        Index("ix_article_comment_count", "comment_count", "article_id"),
+    )
+
+    # when the article was last commented on, or posted if it has no comments
+    @classmethod
+    def last_activity(cls):
+        return func.coalesce(cls.last_comment_at, cls.date_posted)
+
+Index("ix_article_last_activity", Article.last_activity(), Article.article_id)
+
 class Comment(Base):
     __tablename__ = "comment"
  
@@ -153,4 +209,9 @@ class Comment(Base):
     author_id: Mapped[str] = mapped_column(String, ForeignKey('user.username'))
     content: Mapped[str] = mapped_column(String)
     date_posted: Mapped[datetime]= mapped_column(DateTime, default=datetime.now)
+
+    __table_args__ = (
+        Index("ix_comment_article_id", "article_id"),
+        Index("ix_comment_author_id", "author_id"),
+    )
     
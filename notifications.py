@@ -0,0 +1,75 @@
+'''
+notifications
+events pushed to users over their sockets
+
+every socket of a logged in user joins the user's own room, so an event emitted to
+that room reaches all of the user's open pages, on any node when a message queue is
+configured. friend requests and friendships are pushed once the change is committed,
+presence changes are collected for a short while and pushed to the user's friends in
+one go, so a user flapping on and off within that window sends nothing at all
+'''
+
+from threading import Lock, Timer
+
+try:
+    from __main__ import socketio
+except ImportError:
+    from app import socketio
+
+import db
+import config
+
+
+def user_room(username: str):
+    return f"user:{username}"
+
+# emits the event to every socket of the user, once the current unit of work has committed
+def notify(username: str, event: str, data: dict):
+    db.on_commit(lambda: socketio.emit(event, data, to=user_room(username)))
+
+
+class PresenceNotifier():
+    def __init__(self, delay: float = 1.0):
+        self.delay = delay
+        self.lock = Lock()
+        # username -> (status before the first change in this window, latest status)
+        self.pending = {}
+        self.timer = None
+
+    # records that the user came online or went offline
+    def changed(self, username: str, online: bool):
+        with self.lock:
+            before, _ = self.pending.get(username, (not online, None))
+            self.pending[username] = (before, online)
+            if self.timer is None:
+                self.timer = Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    # sends every friend one "presence" event with the users whose status changed
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.timer = None
+        changed = {username: latest for username, (before, latest) in pending.items() if before != latest}
+        if not changed:
+            return
+        friends = db.get_friends_many(list(changed))
+        if friends is None:
+            return
+        updates = {}
+        for username, friend_names in friends.items():
+            for friend in friend_names:
+                updates.setdefault(friend, {})[username] = changed[username]
+        for friend, statuses in updates.items():
+            socketio.emit("presence", statuses, to=user_room(friend))
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.pending = {}
+
+
+presence_notifier = PresenceNotifier(delay=config.PRESENCE_NOTIFY_DELAY)
@@ -0,0 +1,211 @@
+'''
+presence
+process-local registry of which users are online
+
+a user is online while they have at least one socket connected, the registry
+is updated from the socket connect/disconnect handlers and can be read without
+touching the database. changes can optionally be mirrored to the
+User.online_status column, batched up and written after a short delay
+
+when several app nodes run, each node publishes its connects and disconnects
+on the bus so every registry knows about the sockets held by the other nodes.
+nodes also announce themselves on the bus every few seconds, the sockets of a node
+that stops announcing itself, because it crashed or lost the bus, are dropped
+'''
+
+from threading import Lock, Timer, Thread, Event
+import atexit
+import time
+
+from bus import NODE_ID
+import config
+
+
+class PresenceRegistry():
+    def __init__(self, persist=None, delay: float = 2.0, bus=None, node_id: str = NODE_ID,
+                 heartbeat: float = 10.0, node_timeout: float = 30.0):
+        # username -> {socket session id: node holding the socket}
+        self.sessions = {}
+        self.lock = Lock()
+        # callable taking a dict of username -> online status, None disables persisting
+        self.persist = persist
+        self.delay = delay
+        self.pending = {}
+        self.timer = None
+        self.node_id = node_id
+        self.bus = bus
+        # other node id -> time it was last heard from
+        self.node_seen = {}
+        self.heartbeat = heartbeat
+        self.node_timeout = node_timeout
+        self.stopped = Event()
+        if bus is not None:
+            bus.subscribe("presence", self._on_bus_message)
+            if heartbeat:
+                Thread(target=self._heartbeat, name="presence-heartbeat", daemon=True).start()
+
+    # registers a socket for the user, returns True if the user just came online
+    def connect(self, username: str, sid: str):
+        came_online = self._add(username, sid, self.node_id)
+        self._publish({"event": "connect", "username": username, "sid": sid})
+        return came_online
+
+    # removes a socket of the user, returns True if the user just went offline
+    def disconnect(self, username: str, sid: str):
+        went_offline = self._remove(username, sid)
+        self._publish({"event": "disconnect", "username": username, "sid": sid})
+        return went_offline
+
+    def is_online(self, username: str):
+        return username in self.sessions
+
+    # returns a dict of username -> online status
+    def online_many(self, usernames):
+        sessions = self.sessions
+        return {username: username in sessions for username in usernames}
+
+    def online_users(self):
+        with self.lock:
+            return list(self.sessions)
+
+    def sids(self, username: str):
+        with self.lock:
+            return set(self.sessions.get(username, ()))
+
+    def _add(self, username: str, sid: str, node_id: str):
+        with self.lock:
+            sids = self.sessions.setdefault(username, {})
+            came_online = not sids
+            sids[sid] = node_id
+            if came_online and node_id == self.node_id:
+                self._schedule(username, True)
+            return came_online
+
+    def _remove(self, username: str, sid: str):
+        with self.lock:
+            sids = self.sessions.get(username)
+            if not sids or sid not in sids:
+                return False
+            node_id = sids.pop(sid)
+            if sids:
+                return False
+            del self.sessions[username]
+            if node_id == self.node_id:
+                self._schedule(username, False)
+            return True
+
+    # the sockets held by this node, as username -> socket session ids
+    def _local_sessions(self):
+        with self.lock:
+            local = {}
+            for username, sids in self.sessions.items():
+                for sid, node in sids.items():
+                    if node == self.node_id:
+                        local.setdefault(username, []).append(sid)
+            return local
+
+    # announces this node and drops the nodes that have gone quiet
+    def _heartbeat(self):
+        self._publish({"event": "alive"})
+        while not self.stopped.wait(self.heartbeat):
+            self._publish({"event": "alive"})
+            now = time.monotonic()
+            with self.lock:
+                stale = [node for node, seen in self.node_seen.items() if now - seen > self.node_timeout]
+                for node_id in stale:
+                    del self.node_seen[node_id]
+            for node_id in stale:
+                print(f"Presence: node {node_id} stopped responding, dropping its sockets.")
+                self._forget_node(node_id)
+
+    # drops every socket held by a node, used when that node shuts down or goes quiet
+    def _forget_node(self, node_id: str):
+        with self.lock:
+            for username in list(self.sessions):
+                sids = self.sessions[username]
+                for sid in [sid for sid, node in sids.items() if node == node_id]:
+                    del sids[sid]
+                if not sids:
+                    del self.sessions[username]
+
+    def _publish(self, message: dict):
+        if self.bus is None:
+            return
+        message["node"] = self.node_id
+        try:
+            self.bus.publish("presence", message)
+        except Exception as e:
+            print("An error occurred while publishing presence:", e)
+
+    # applies connects and disconnects published by other nodes
+    def _on_bus_message(self, message: dict):
+        node_id = message.get("node")
+        if node_id == self.node_id:
+            return
+        event = message.get("event")
+        if event == "node_down":
+            with self.lock:
+                self.node_seen.pop(node_id, None)
+            self._forget_node(node_id)
+            return
+        with self.lock:
+            new_node = node_id not in self.node_seen
+            self.node_seen[node_id] = time.monotonic()
+        if new_node:
+            # a node that just started, or was dropped, has to learn about the sockets held here
+            self._publish({"event": "sessions", "sessions": self._local_sessions()})
+        if event == "connect":
+            self._add(message["username"], message["sid"], node_id)
+        elif event == "disconnect":
+            self._remove(message["username"], message["sid"])
+        elif event == "sessions":
+            for username, sids in message["sessions"].items():
+                for sid in sids:
+                    self._add(username, sid, node_id)
+
+    # queues a status change to be written to the database, must hold the lock
+    def _schedule(self, username: str, status: bool):
+        if self.persist is None:
+            return
+        self.pending[username] = status
+        if self.timer is None:
+            self.timer = Timer(self.delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    # writes all queued status changes to the database in one go
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.timer = None
+        if pending and self.persist is not None:
+            try:
+                self.persist(pending)
+            except Exception as e:
+                print("An error occurred while persisting online status:", e)
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        self.flush()
+        # tell the other nodes that the sockets held here are gone
+        self._publish({"event": "node_down"})
+
+
+def _create_registry():
+    from bus import bus
+    liveness = {"heartbeat": config.PRESENCE_NODE_HEARTBEAT, "node_timeout": config.PRESENCE_NODE_TIMEOUT}
+    if not config.PRESENCE_PERSIST:
+        return PresenceRegistry(bus=bus, **liveness)
+    import db
+    return PresenceRegistry(persist=db.set_online_statuses, delay=config.PRESENCE_PERSIST_DELAY, bus=bus,
+                            **liveness)
+
+registry = _create_registry()
+
+# registered after db's own exit hook, so pending writes land before
+# db sets every user offline on a single node sqlite setup
+atexit.register(registry.close)
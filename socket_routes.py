@@ -5,7 +5,8 @@ file containing all the routes related to socket.io
 
 
 from flask_socketio import join_room, emit, leave_room, SocketIO, rooms
-from flask import request
+from flask import request, session
+import atexit
 
 try:
     from __main__ import socketio
@@ -15,71 +16,120 @@ except ImportError:
 from models import Room
 
 import db
+from presence import registry as presence
+from message_writer import writer as message_writer
+from notifications import user_room, presence_notifier
+from broadcast import RoomBroadcaster
+import config
 import hashlib 
 from cryptography.hazmat.primitives.asymmetric import dh
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 
-# Dictionary to store shared keys by room ID
-shared_keys = {}
+# handlers that touch the database run in a db.unit_of_work,
+# which shares one session for the whole event and commits it once
+
+# chat messages and their macs are sent to a sub-room of the chat room: one per packet,
+# or in batches for the clients that opted in with the "batch_messages" event
+def message_room(room_id, batched: bool):
+    return f"{room_id}:{'batched' if batched else 'messages'}"
+
+def join_chat_room(room_id):
+    join_room(room_id)
+    join_room(message_room(room_id, session.get("batch_messages", False)))
+
+def leave_chat_room(room_id):
+    leave_room(room_id)
+    leave_room(message_room(room_id, session.get("batch_messages", False)))
+
+broadcaster = RoomBroadcaster(socketio, window=config.SOCKETIO_BATCH_WINDOW, max_batch=config.SOCKETIO_BATCH_MAX)
+atexit.register(broadcaster.close)
+
+# a client that handles "incoming_batch" events opts in to batched chat messages
+@socketio.on("batch_messages")
+def batch_messages(enabled=True):
+    enabled = bool(enabled)
+    session["batch_messages"] = enabled
+    # move the chat rooms already joined over to the right sub-room
+    for room in rooms():
+        if isinstance(room, str) and room.endswith((":messages", ":batched")):
+            room_id = room.rsplit(":", 1)[0]
+            leave_room(room)
+            join_room(message_room(room_id, enabled))
 
 # when the client connects to a socket
 # this event is emitted when the io() function is called in JS
 @socketio.on('connect')
-def connect():
-    username = request.cookies.get("username")
-    room_id = request.cookies.get("room_id")
-    if room_id is None or username is None:
-        return
-    # socket automatically leaves a room on client disconnect
-    # so on client connect, the room needs to be rejoined
-
-    # if the user is already inside of a room 
-    if room_id is not None:
-        join_room(int(room_id))
-        emit("warnings", (f"{username} has connected", "green"), to=int(room_id))
-        
-        user = db.get_participants(room_id)
-        # checking online status
-        online_count = 0
-        receiver = None
-        for u in user: 
-            if (db.get_online_status(u) == True):
-                online_count += 1
-            if u != username:
-                receiver = u
-        if receiver == None:
-            emit("warnings", ("You are the only one in the chat!", "green"))
-        elif online_count == 1:
-            emit("warnings", (f"{receiver} is not online. Messages will not be received!", "green"))
-
-        emit("connected", room_id)
-        return room_id
+@db.unit_of_work()
+def connect(auth=None):
+    # every page opens a socket, only the login session identifies its user,
+    # the username cookie is set by the page itself so it can't be trusted
+    username = session.get("username")
+    if username is not None:
+        # the user's own room receives the notifications meant for them
+        join_room(user_room(username))
+        if presence.connect(username, request.sid):
+            presence_notifier.changed(username, True)
+
+# socket automatically leaves a room on client disconnect,
+# so the chat page asks to rejoin the room it was in every time its socket connects,
+# other pages don't join chat rooms
+@socketio.on("rejoin_room")
+@db.unit_of_work()
+def rejoin_room(room_id):
+    username = session.get("username")
+    try:
+        room_id = int(room_id)
+    except (TypeError, ValueError):
+        return None
+    if username is None or username not in (db.get_participants(room_id) or []):
+        return None
+
+    join_chat_room(room_id)
+    emit("warnings", (f"{username} has connected", "green"), to=room_id)
+
+    participants = presence.online_many(db.get_participants(room_id) or [])
+    online_count = sum(participants.values())
+    receiver = None
+    for u in participants:
+        if u != username:
+            receiver = u
+    if receiver == None:
+        emit("warnings", ("You are the only one in the chat!", "green"))
+    elif online_count == 1:
+        emit("warnings", (f"{receiver} is not online. Messages will not be received!", "green"))
+
+    emit("connected", room_id)
+    return room_id
 
 
 # event when client disconnects
 # quite unreliable use sparingly
 @socketio.on('disconnect')
+@db.unit_of_work()
 def disconnect():
-    username = request.cookies.get("username")
-    room_id = request.cookies.get("room_id")
-    if room_id is None or username is None:
+    username = session.get("username")
+    if username is None:
         return
-        
-    emit("warnings", (f"{username} has left the room.", "red"), to=int(room_id))
-    leave_room(room_id)
+    if presence.disconnect(username, request.sid):
+        presence_notifier.changed(username, False)
+
+    # chat rooms are the integer rooms, only sockets of the chat page are in one
+    for room in rooms():
+        if isinstance(room, int):
+            emit("warnings", (f"{username} has left the room.", "red"), to=room)
+            leave_chat_room(room)
 
 # send message event handler
 @socketio.on("send")
+@db.unit_of_work()
 def send(username, message, room_id):
-    emit("incoming", (f"{username}: {message}"), to=room_id)
-    user = db.get_participants(room_id)
-    # checking online status
-    online_count = 0
+    emit("incoming", (f"{username}: {message}"), to=message_room(room_id, False))
+    broadcaster.publish(message_room(room_id, True), "incoming", f"{username}: {message}")
+    participants = presence.online_many(db.get_participants(room_id) or [])
+    online_count = sum(participants.values())
     receiver = None
-    for u in user: 
-        if (db.get_online_status(u) == True):
-            online_count += 1
+    for u in participants:
         if u != username:
             receiver = u
 
@@ -87,12 +137,13 @@ def send(username, message, room_id):
     if online_count < 2 and receiver != None:
         emit("warnings", (f"{receiver} is not online. Messages will not be received!", "green"))
     
-    if len(user) < 2:
+    if len(participants) < 2:
         emit("warnings", ("Your the only one in the chat room!", "green"))
 
 # join room event handler
 # sent when the user joins a room
 @socketio.on("join")
+@db.unit_of_work()
 def join(sender_name, receiver_name):
     receiver = db.get_user(receiver_name)
     if receiver is None:
@@ -112,7 +163,7 @@ def join(sender_name, receiver_name):
             print("Error: cannot create a room")
             return
         room_id = db.find_exclusive_room(sender_name, receiver_name)
-    join_room(room_id)
+    join_chat_room(room_id)
 
     # emit to everyone in the room except the sender
     emit("warnings", (f"{sender_name} has joined the room.", "green"), to=room_id, include_self=False)
@@ -120,12 +171,13 @@ def join(sender_name, receiver_name):
     emit("warnings", (f"{sender_name} has joined the room. Now talking to {receiver_name}.", "green"))
 
     # if the receiver is not online, notify the sender
-    if db.get_online_status(receiver_name) == False and receiver != None:
+    if not presence.is_online(receiver_name) and receiver != None:
         emit("warnings", (f"{receiver_name} is not online. Messages will not be received!", "green"))
     
     return int(room_id)
 
 @socketio.on("create_group")
+@db.unit_of_work()
 def create_group(username, chat_name):
     room_id = db.get_room_id_by_name(chat_name)
 
@@ -134,7 +186,7 @@ def create_group(username, chat_name):
             print("Error: cannot create a group chat")
             return
         room_id = db.get_room_id_by_name(chat_name)
-        join_room(room_id)
+        join_chat_room(room_id)
         # emit to everyone in the room except the sender
         emit("warnings", (f"{username} has joined the room.", "green"), to=room_id, include_self=False)
         # emit only to the sender
@@ -145,14 +197,14 @@ def create_group(username, chat_name):
         return None
 
 @socketio.on("join_group")
+@db.unit_of_work()
 def join_group(username, chat_name):
     room_id = db.get_room_id_by_name(chat_name)
     if room_id is None:
         print("Room doesn't exist!")
         return None
 
-    room_id = db.get_room_id_by_name(chat_name)
-    join_room(room_id)
+    join_chat_room(room_id)
 
     if (not username in db.get_participants(room_id)):
         db.add_participant(username, room_id)
@@ -165,9 +217,10 @@ def join_group(username, chat_name):
 
 # leave room event handler
 @socketio.on("leave")
+@db.unit_of_work()
 def leave(username, room_id):
     emit("warnings", (f"{username} has left the room.", "red"), to=room_id)
-    leave_room(room_id)
+    leave_chat_room(room_id)
     db.delete_participant(username, room_id)
 
 @socketio.on("ask_receiver_public_key")
@@ -186,6 +239,7 @@ def send_receiver_secret_key(secretKey, room_id):
     emit("send_receiver_secret_key", secretKey, to=room_id, include_self=False)
 
 @socketio.on("get_hashed_passwords")
+@db.unit_of_work()
 def get_hashed_passwords(sender_name, receiver_name):
     sender_hashed_password = db.get_user(sender_name).password
     receiver_hashed_password = db.get_user(receiver_name).password
@@ -196,28 +250,65 @@ def get_room_salt(room_id):
     return room.get_room_salt(room_id)
 
 @socketio.on("store_encrypted_key")
+@db.unit_of_work()
 def store_encrypted_key(username, room_id, encryptedKey):
-    db.insert_encryption_key(username, room_id, encryptedKey)
-    db.get_encryption_key(username, room_id)
-    return True
+    # only ever stores the logged in user's key, the username the client sends is ignored
+    username = session.get("username")
+    if username is None:
+        return False
+    return db.insert_encryption_key(username, room_id, encryptedKey)
 
+# acks with the user's encrypted key for the room, or None
 @socketio.on("get_encrypted_key")
+@db.unit_of_work()
 def get_encrypted_key(username, room_id):
-    db.get_encryption_key(username, room_id)
-    return True
+    # only ever the logged in user's key, the username the client sends is ignored
+    username = session.get("username")
+    if username is None:
+        return None
+    return db.get_encryption_key(username, room_id)
+
+# acks with every encrypted key of the logged in user, as room_id -> encrypted key,
+# so the chat page loads all its room keys in one round trip
+@socketio.on("get_encrypted_keys")
+@db.unit_of_work()
+def get_encrypted_keys():
+    username = session.get("username")
+    if username is None:
+        return {}
+    return db.get_encryption_keys(username) or {}
 
 @socketio.on("store_encrypted_message")
 def store_encrypted_message(room_id, encryptedMessage):
-    db.store_encrypted_message(room_id, encryptedMessage)
-    return True
+    # written to the database in batches by the background writer
+    return message_writer.submit(room_id, encryptedMessage)
+
+# returns a page of the room's message history, newest page first
+# clients scroll back by passing the page's before_message_id in again
+MESSAGE_PAGE_LIMIT = 50
+MAX_MESSAGE_PAGE_LIMIT = 500
 
 @socketio.on("get_encrypted_messages")
-def get_encrypted_messages(room_id):
-    return db.retrieve_encrypted_messages(room_id)
+@db.unit_of_work()
+def get_encrypted_messages(room_id, before_message_id=None, limit=MESSAGE_PAGE_LIMIT):
+    try:
+        limit = max(1, min(int(limit), MAX_MESSAGE_PAGE_LIMIT))
+        if before_message_id is not None:
+            before_message_id = int(before_message_id)
+    except (TypeError, ValueError):
+        return None
+    # make sure the room's messages still waiting in the write queue are part of the history,
+    # a history missing them is an error rather than a page that looks complete
+    if not message_writer.flush(room_id, timeout=1.0):
+        print("Error occurred: the room's queued messages were not written in time")
+        return None
+    return db.retrieve_encrypted_messages_page(room_id, before_message_id, limit)
 
 @socketio.on("send_mac")
 def send_mac(mac, room_id):
-    emit("send_mac", mac, to=room_id)
+    # follows its message, so it goes the same way
+    emit("send_mac", mac, to=message_room(room_id, False))
+    broadcaster.publish(message_room(room_id, True), "send_mac", mac)
 
 @socketio.on("send_combined_key")
 def send_combined_key(combined_key, room_id):
@@ -229,4 +320,5 @@ def request_combined_key(room_id):
 
 @socketio.on("send_encrypt_message")
 def send_encrypt_message(mac, room_id):
-    emit("send_mac", mac, to=room_id)
\ No newline at end of file
+    emit("send_mac", mac, to=message_room(room_id, False))
+    broadcaster.publish(message_room(room_id, True), "send_mac", mac)
\ No newline at end of file
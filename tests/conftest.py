@@ -0,0 +1,16 @@
+'''
+conftest
+points db.py at a throwaway sqlite database before any test imports it
+'''
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+_database = tempfile.mkdtemp(prefix="chat-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_database, 'test.db')}"
+# the tests don't check passwords, hash on the calling thread with few iterations
+os.environ.setdefault("HASH_WORKERS", "0")
+os.environ.setdefault("PASSWORD_HASH_ITERATIONS", "1000")
@@ -0,0 +1,77 @@
+'''
+test_bulk
+checks that an export imports into an empty database unchanged, and that importing it again adds nothing
+'''
+
+import pytest
+from sqlalchemy import func, select
+
+import bulk
+import db
+from models import Base
+
+
+@pytest.fixture(scope="module", autouse=True)
+def data():
+    for username in ("bulk_alice", "bulk_bob"):
+        if db.get_user(username) is None:
+            db.insert_user(username, "password")
+    db.add_friendship("bulk_alice", "bulk_bob")
+    if db.find_exclusive_room("bulk_alice", "bulk_bob") is None:
+        db.create_room("bulk_alice", "bulk_bob", False)
+    room_id = db.find_exclusive_room("bulk_alice", "bulk_bob")
+    db.store_encrypted_messages([(room_id, f"bulk message {i}") for i in range(25)])
+    db.insert_encryption_key("bulk_alice", room_id, "key")
+    db.add_article("bulk_alice", "Bulk", "exported and imported", "general")
+
+
+# every row of every table, in a stable order
+def dump(engine):
+    with engine.connect() as connection:
+        return {table.name: sorted(map(tuple, connection.execute(select(table))), key=repr)
+                for table in Base.metadata.sorted_tables}
+
+
+@pytest.fixture
+def empty_database(tmp_path, monkeypatch):
+    engine = db.create_db_engine(f"sqlite:///{tmp_path / 'imported.db'}")
+    Base.metadata.create_all(engine)
+    monkeypatch.setattr(db, "engine", engine)
+    db.create_search_index()
+    yield engine
+    engine.dispose()
+
+
+def test_round_trip(tmp_path, empty_database):
+    path = str(tmp_path / "export.ndjson.gz")
+    original = dump(db.create_db_engine())
+    # export from the test database, import into the empty one
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(db, "engine", db.create_db_engine())
+        exported = bulk.export_data(path, chunk_size=7)
+    assert exported == sum(len(rows) for rows in original.values())
+
+    assert bulk.import_data(path, chunk_size=7) == exported
+    assert dump(empty_database) == original
+    # the imported articles are searchable
+    assert db.search_forum("imported")["results"]
+
+
+def test_import_again_adds_nothing(tmp_path, empty_database):
+    path = str(tmp_path / "export.ndjson")
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(db, "engine", db.create_db_engine())
+        bulk.export_data(path)
+    bulk.import_data(path)
+    imported = dump(empty_database)
+    bulk.import_data(path)
+    assert dump(empty_database) == imported
+    with empty_database.connect() as connection:
+        friendships = connection.execute(select(func.count()).select_from(db.association_table).where(
+            db.association_table.c.user_id == "bulk_alice")).scalar()
+    assert friendships == 1
+
+
+def test_unknown_table(tmp_path):
+    with pytest.raises(ValueError):
+        bulk.export_data(str(tmp_path / "export.ndjson"), tables=["no_such_table"])
@@ -0,0 +1,93 @@
+'''
+test_bus
+checks the in-process LocalBus, and that cache invalidations published by db.py on one node
+are applied by the others
+'''
+
+import pytest
+
+import bus as bus_module
+import db
+from bus import LocalBus, create_bus, NODE_ID
+
+
+def test_local_bus_delivers_to_the_channel_subscribers():
+    bus = LocalBus()
+    received = []
+    bus.subscribe("a", lambda message: received.append(("first", message)))
+    bus.subscribe("a", lambda message: received.append(("second", message)))
+    bus.subscribe("b", lambda message: received.append(("other channel", message)))
+    bus.publish("a", {"n": 1})
+    bus.publish("c", {"n": 2})
+    assert received == [("first", {"n": 1}), ("second", {"n": 1})]
+
+
+def test_local_bus_handler_errors_dont_stop_the_others():
+    bus = LocalBus()
+    received = []
+
+    def fail(message):
+        raise ValueError("broken handler")
+
+    bus.subscribe("a", fail)
+    bus.subscribe("a", received.append)
+    bus.publish("a", {"n": 1})
+    assert received == [{"n": 1}]
+
+
+def test_create_bus():
+    assert isinstance(create_bus(""), LocalBus)
+    assert isinstance(create_bus("local://"), LocalBus)
+    with pytest.raises(ValueError):
+        create_bus("amqp://localhost")
+
+
+# messages db.py publishes on the cache channel
+@pytest.fixture
+def published(monkeypatch):
+    messages = []
+    monkeypatch.setattr(db, "bus", LocalBus())
+    db.bus.subscribe("cache", messages.append)
+    return messages
+
+
+def test_invalidations_are_published_once_committed(published):
+    with db.unit_of_work():
+        db.insert_encryption_key("bus_alice", 1, "key")
+        assert published == []
+    assert published == [{"node": NODE_ID, "cache": "encryption_key", "key": ["bus_alice", 1]}]
+
+
+def test_invalidations_are_not_published_on_rollback(published):
+    with pytest.raises(ValueError):
+        with db.unit_of_work():
+            db.insert_encryption_key("bus_alice", 2, "key")
+            raise ValueError("request failed")
+    assert published == []
+
+
+# another node's invalidation, as it arrives over the bus
+def from_other_node(cache, key):
+    bus_module.bus.publish("cache", {"node": "other-node", "cache": cache, "key": key})
+
+
+def test_other_nodes_invalidations_are_applied():
+    db.encryption_key_cache.put(("bus_bob", 1), "stale key")
+    db.comment_thread_cache.put(1, "stale thread")
+    db.participants_cache.put(7, ("bus_bob",))
+    db.user_rooms_cache.put("bus_bob", ("room",))
+    db.exclusive_room_cache.put(("bus_bob", "bus_carol"), 7)
+    from_other_node("encryption_key", ["bus_bob", 1])
+    from_other_node("comment_thread", 1)
+    from_other_node("membership", ["bus_bob", 7])
+    assert db.encryption_key_cache.get(("bus_bob", 1)) is None
+    assert db.comment_thread_cache.get(1) is None
+    assert db.participants_cache.get(7) is None
+    assert db.user_rooms_cache.get("bus_bob") is None
+    assert db.exclusive_room_cache.get(("bus_bob", "bus_carol")) is None
+
+
+def test_own_invalidations_are_ignored():
+    db.encryption_key_cache.put(("bus_bob", 2), "fresh key")
+    bus_module.bus.publish("cache", {"node": NODE_ID, "cache": "encryption_key", "key": ["bus_bob", 2]})
+    assert db.encryption_key_cache.get(("bus_bob", 2)) == "fresh key"
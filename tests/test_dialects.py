@@ -0,0 +1,73 @@
+'''
+test_dialects
+checks the paths db.py takes on postgresql: the upserts are compiled for its dialect,
+and the forum search falls back to matching words when there is no fts5 index
+'''
+
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.dialects import postgresql, sqlite
+
+import db
+from models import MessageDecryptionKeys, association_table
+
+
+@pytest.fixture
+def on_postgresql(monkeypatch):
+    monkeypatch.setattr(db, "engine", SimpleNamespace(dialect=postgresql.dialect()))
+
+
+def compiled(statement, dialect):
+    return " ".join(str(statement.compile(dialect=dialect)).split())
+
+
+def key_upsert():
+    statement = db.dialect_insert(MessageDecryptionKeys).values(username="alice", room_id=1, encrypted_key="key")
+    return statement.on_conflict_do_update(
+        index_elements=[MessageDecryptionKeys.username, MessageDecryptionKeys.room_id],
+        set_={"encrypted_key": statement.excluded.encrypted_key},
+    )
+
+
+def test_upsert_on_postgresql(on_postgresql):
+    sql = compiled(key_upsert(), postgresql.dialect())
+    assert "ON CONFLICT (username, room_id) DO UPDATE SET encrypted_key = excluded.encrypted_key" in sql
+
+
+def test_insert_ignoring_duplicates_on_postgresql(on_postgresql):
+    sql = compiled(db.dialect_insert(association_table).on_conflict_do_nothing(), postgresql.dialect())
+    assert sql.endswith("ON CONFLICT DO NOTHING")
+
+
+def test_upsert_on_sqlite():
+    sql = compiled(key_upsert(), sqlite.dialect())
+    assert "ON CONFLICT (username, room_id) DO UPDATE SET encrypted_key = excluded.encrypted_key" in sql
+
+
+def test_upsert_replaces_the_key():
+    assert db.insert_encryption_key("dialect_alice", 1, "first")
+    assert db.insert_encryption_key("dialect_alice", 1, "second")
+    db.encryption_key_cache.clear()
+    assert db.get_encryption_key("dialect_alice", 1) == "second"
+
+
+@pytest.fixture
+def articles():
+    if db.get_user("dialect_alice") is None:
+        db.insert_user("dialect_alice", "password")
+    db.add_article("dialect_alice", "Graph algorithms", "Dijkstra finds shortest paths", "cs")
+    db.add_article("dialect_alice", "Linear algebra", "the graph laplacian", "math")
+
+
+def test_search_without_fts5(articles, monkeypatch):
+    # postgresql has no fts5 index, search_forum matches every word in the title or content instead
+    monkeypatch.setattr(db, "search_index_enabled", lambda: False)
+    titles = lambda query: [result["title"] for result in db.search_forum(query)["results"]]
+    assert set(titles("GRAPH")) >= {"Graph algorithms", "Linear algebra"}
+    assert "Graph algorithms" in titles("graph dijkstra")
+    assert "Linear algebra" not in titles("graph dijkstra")
+    assert titles("no such words anywhere") == []
+    # nothing to suspend without the index
+    with db.search_index_suspended():
+        pass
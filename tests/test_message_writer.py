@@ -0,0 +1,82 @@
+'''
+test_message_writer
+checks that the write-behind writer batches messages, retries a failed batch row by row
+and that flush waits for the queued messages
+'''
+
+import pytest
+
+import db
+from message_writer import MessageWriter
+
+
+@pytest.fixture(scope="module")
+def room_id():
+    if db.get_user("writer_alice") is None:
+        db.insert_user("writer_alice", "password")
+    if db.get_room_id_by_name("writer_room") is None:
+        db.create_room("writer_alice", "writer_room", True)
+    return db.get_room_id_by_name("writer_room")
+
+
+@pytest.fixture
+def writer():
+    writer = MessageWriter(batch_size=100, flush_interval=0.05)
+    yield writer
+    writer.close()
+
+
+def history(room_id):
+    return [message["encrypted_message"]
+            for message in db.retrieve_encrypted_messages_page(room_id, limit=500)["messages"]]
+
+
+def test_writes_in_batches(writer, room_id):
+    for i in range(250):
+        assert writer.submit(room_id, f"batched {i}")
+    assert writer.flush(timeout=5)
+    assert [m for m in history(room_id) if m.startswith("batched")] == [f"batched {i}" for i in range(250)]
+    stats = writer.stats()
+    assert stats["written"] == 250
+    assert stats["batches"] < 250
+
+
+def test_rejects_malformed_messages(writer, room_id):
+    assert writer.submit(room_id, None) is False
+    assert writer.submit("not a room", "message") is False
+    assert writer.submit(str(room_id), "room id as a string")
+    assert writer.flush(timeout=5)
+    assert writer.stats()["failed"] == 2
+    assert "room id as a string" in history(room_id)
+
+
+def test_failed_batch_is_written_row_by_row(writer, room_id, monkeypatch):
+    store_one = db.store_encrypted_message
+    monkeypatch.setattr(db, "store_encrypted_messages", lambda messages: False)
+    monkeypatch.setattr(db, "store_encrypted_message",
+                        lambda room_id, message: message != "bad row" and store_one(room_id, message))
+    for message in ("good row 1", "bad row", "good row 2"):
+        writer.submit(room_id, message)
+    # the bad row is lost, so flush reports the failure
+    assert writer.flush(timeout=5) is False
+    assert [m for m in history(room_id) if m.endswith("row 1") or m.endswith("row 2") or m == "bad row"] \
+        == ["good row 1", "good row 2"]
+    stats = writer.stats()
+    assert stats["written"] == 2
+    assert stats["failed"] == 1
+
+
+def test_flush_of_a_room_without_queued_rows_returns_at_once(writer, room_id, monkeypatch):
+    # the writer is stuck on another room's batch
+    monkeypatch.setattr(writer, "_write", lambda batch: None)
+    writer.submit(room_id + 1000, "other room")
+    assert writer.flush(room_id, timeout=0) is True
+    assert writer.flush(room_id + 1000, timeout=0.1) is False
+
+
+def test_close_writes_what_is_queued(room_id):
+    writer = MessageWriter(flush_interval=10)
+    writer.submit(room_id, "written on close")
+    writer.close()
+    assert "written on close" in history(room_id)
+    assert writer.submit(room_id, "after close") is False
@@ -0,0 +1,116 @@
+'''
+test_query_plans
+checks that the hot db.py lookups are answered from an index, with EXPLAIN QUERY PLAN,
+a query that scans one of these tables gets slower with every row it holds
+'''
+
+import re
+
+import pytest
+from sqlalchemy import event
+
+import cache
+import db
+
+TABLES = {"user", "association", "friend_request", "room", "participant", "message_history",
+          "message_decryption_keys", "article", "comment"}
+
+
+@pytest.fixture(scope="module", autouse=True)
+def data():
+    for username in ("alice", "bob", "carol"):
+        if db.get_user(username) is None:
+            db.insert_user(username, "password")
+    db.add_friendship("alice", "bob")
+    db.add_friendship("bob", "carol")
+    db.send_request("carol", "alice")
+    if db.find_exclusive_room("alice", "bob") is None:
+        db.create_room("alice", "bob", False)
+    room_id = db.find_exclusive_room("alice", "bob")
+    db.store_encrypted_messages([(room_id, f"message {i}") for i in range(10)])
+    db.insert_encryption_key("alice", room_id, "key")
+    # two articles, so the first page of one has a cursor to the next
+    db.add_article("alice", "Exams", "when are the exams", "general")
+    db.add_article("bob", "Lectures", "are the lectures recorded", "general")
+    article_id = db.list_articles(limit=1)["articles"][0]["article_id"]
+    db.add_comment(article_id, "bob", "next week")
+    return {"room_id": room_id, "article_id": article_id}
+
+
+# the query plans of every statement call runs, with the lookup caches cleared first
+def plans_of(call):
+    for value in vars(db).values():
+        if isinstance(value, cache.LRUCache):
+            value.clear()
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((cursor.connection, statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", capture)
+    try:
+        call()
+        plans = [(statement, [row[-1] for row in connection.execute("EXPLAIN QUERY PLAN " + statement, parameters)])
+                 for connection, statement, parameters in statements]
+    finally:
+        event.remove(db.engine, "before_cursor_execute", capture)
+    assert plans, "the call ran no queries"
+    return plans
+
+
+# every access to a table is an index search, never a full scan,
+# a page in index order may walk the index, it stops after LIMIT rows
+def assert_indexed(call):
+    for statement, plan in plans_of(call):
+        for step in plan:
+            scan = re.match(r"SCAN (\w+)", step)
+            if scan and scan.group(1) in TABLES:
+                assert "LIMIT" in statement and re.search(r"USING (COVERING )?INDEX", step), \
+                    f"{step} in {statement}\n{plan}"
+                assert not any("TEMP B-TREE" in other for other in plan), f"{statement}\n{plan}"
+            search = re.match(r"SEARCH (\w+)", step)
+            if search and search.group(1) in TABLES:
+                assert re.search(r"USING (COVERING INDEX|INDEX|INTEGER PRIMARY KEY|PRIMARY KEY)", step), \
+                    f"{step} in {statement}\n{plan}"
+
+
+def test_participant_lookups(data):
+    assert_indexed(lambda: db.get_participants(data["room_id"]))
+    assert_indexed(lambda: db.get_user_chatrooms("alice"))
+    assert_indexed(lambda: db.find_exclusive_room("alice", "bob"))
+
+
+def test_association_lookups():
+    assert_indexed(lambda: db.get_friends("alice"))
+    assert_indexed(lambda: db.are_friends("alice", "bob"))
+    assert_indexed(lambda: db.get_mutual_friends("alice", "carol"))
+    assert_indexed(lambda: db.get_friends_many(["alice", "bob"]))
+
+
+def test_friend_request_lookups():
+    assert_indexed(lambda: db.get_requests("alice"))
+
+
+def test_message_history_lookups(data):
+    assert_indexed(lambda: db.retrieve_encrypted_messages_page(data["room_id"]))
+    assert_indexed(lambda: db.retrieve_encrypted_messages_page(data["room_id"], before_message_id=5))
+    assert_indexed(lambda: db.get_encryption_key("alice", data["room_id"]))
+
+
+def test_comment_lookups(data):
+    assert_indexed(lambda: db.get_comment_thread(data["article_id"]))
+    assert_indexed(lambda: db.get_comments(data["article_id"]))
+
+
+@pytest.mark.parametrize("order", sorted(db.ARTICLE_ORDERINGS))
+def test_article_pages(order):
+    cursor = db.list_articles(limit=1, order=order)["cursor"]
+    assert cursor is not None
+    assert_indexed(lambda: db.list_articles(limit=20, order=order))
+    assert_indexed(lambda: db.list_articles(before=cursor, limit=20, order=order))
+
+
+def test_article_filters():
+    assert_indexed(lambda: db.list_articles(category="general"))
+    assert_indexed(lambda: db.list_articles(author="alice"))
@@ -0,0 +1,127 @@
+'''
+test_unit_of_work
+checks that a unit of work shares one session, commits once at the end, rolls back on errors,
+counts its queries and fills the caches only after it has committed
+'''
+
+import pytest
+from sqlalchemy import event
+
+import db
+
+
+@pytest.fixture(scope="module", autouse=True)
+def users():
+    for username in ("uow_alice", "uow_bob"):
+        if db.get_user(username) is None:
+            db.insert_user(username, "password")
+
+
+# counts the transactions committed on the engine while the block runs
+@pytest.fixture
+def commits():
+    count = [0]
+
+    def committed(conn):
+        count[0] += 1
+
+    event.listen(db.engine, "commit", committed)
+    yield count
+    event.remove(db.engine, "commit", committed)
+
+
+def titles():
+    return [article["title"] for article in db.list_articles(author="uow_alice", limit=100)["articles"]]
+
+
+def test_commits_once(commits):
+    with db.unit_of_work():
+        db.add_article("uow_alice", "Once 1", "content", "general")
+        db.add_article("uow_alice", "Once 2", "content", "general")
+        assert commits[0] == 0
+    assert commits[0] == 1
+    assert {"Once 1", "Once 2"} <= set(titles())
+
+
+def test_rolls_back_on_error():
+    with pytest.raises(ValueError):
+        with db.unit_of_work():
+            db.add_article("uow_alice", "Rolled back", "content", "general")
+            raise ValueError("request failed")
+    assert "Rolled back" not in titles()
+
+
+def test_failed_call_keeps_earlier_writes():
+    with db.unit_of_work():
+        db.add_article("uow_alice", "Kept", "content", "general")
+        # no such request, the call rolls back its own changes only
+        assert db.accept_friend_request("uow_alice", "uow_bob") is False
+        assert db.add_comment(-1, "uow_bob", "no such article") is False
+    assert "Kept" in titles()
+
+
+def test_failed_commit_raises(monkeypatch):
+    def fail(session):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(db.Session, "commit", fail)
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work():
+            db.add_article("uow_alice", "Not saved", "content", "general")
+    monkeypatch.undo()
+    assert "Not saved" not in titles()
+
+
+def test_counts_queries():
+    db.participants_cache.clear()
+    before = db.queries_executed
+    with db.unit_of_work() as unit:
+        db.get_friends("uow_alice")
+        db.get_requests("uow_alice")
+    # one query each, the savepoints around them aren't counted
+    assert unit.queries == 2
+    assert db.queries_executed - before == 2
+
+
+def test_nested_unit_of_work_joins_the_outer_one(commits):
+    with db.unit_of_work() as outer:
+        with db.unit_of_work() as inner:
+            db.get_friends("uow_alice")
+        assert inner is outer
+        assert commits[0] == 0
+    assert outer.queries == 1
+
+
+def test_caches_filled_on_commit():
+    db.create_room("uow_alice", "uow_group", True)
+    room_id = db.get_room_id_by_name("uow_group")
+    db.participants_cache.clear()
+    with db.unit_of_work():
+        assert db.get_participants(room_id) == ["uow_alice"]
+        assert db.participants_cache.get(room_id) is None
+    assert db.participants_cache.get(room_id) == ("uow_alice",)
+
+
+def test_caches_not_filled_on_rollback():
+    db.room_name_cache.clear()
+    with pytest.raises(ValueError):
+        with db.unit_of_work():
+            db.create_room("uow_alice", "uow_phantom", True)
+            assert db.get_room_id_by_name("uow_phantom") is not None
+            raise ValueError("request failed")
+    assert db.room_name_cache.get("uow_phantom") is None
+    assert db.get_room_id_by_name("uow_phantom") is None
+
+
+def test_on_commit_runs_after_commit_only():
+    ran = []
+    db.on_commit(lambda: ran.append("outside"))
+    assert ran == ["outside"]
+    with db.unit_of_work():
+        db.on_commit(lambda: ran.append("committed"))
+        assert ran == ["outside"]
+    with pytest.raises(ValueError):
+        with db.unit_of_work():
+            db.on_commit(lambda: ran.append("rolled back"))
+            raise ValueError("request failed")
+    assert ran == ["outside", "committed"]